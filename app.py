@@ -1,7 +1,13 @@
-import os, asyncio, aiosqlite, re, uuid, httpx
-from datetime import datetime
-from quart import Quart, request, jsonify, send_from_directory
-from telethon import TelegramClient, events, functions, types, errors
+import os, sys, asyncio, aiosqlite, re, uuid, httpx, json, time, random, hashlib, tempfile, functools, zlib, bisect
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta
+from quart import Quart, Response, request, jsonify, make_response
+from quart.helpers import send_file as quart_send_file
+from quart.wrappers.response import FileBody
+from werkzeug.datastructures import ContentRange
+from werkzeug.security import safe_join
+from telethon import TelegramClient, events, functions, types, errors, utils
 
 app = Quart(__name__)
 
@@ -14,13 +20,116 @@ API_HASH = os.environ.get('API_HASH', '')
 # Добавляем пустую строку как значение по умолчанию, чтобы код не упал при запуске
 WA_ID_INSTANCE = os.environ.get("WA_ID_INSTANCE", "")
 WA_API_TOKEN = os.environ.get("WA_API_TOKEN", "")
+# Адрес API можно переопределить (например, на локальный фейковый сервер для тестов)
+WA_API_URL = os.environ.get("WA_API_URL", "https://api.green-api.com")
+WA_TIMEOUT = float(os.environ.get("WA_TIMEOUT", 10))
+WA_MAX_CONNECTIONS = int(os.environ.get("WA_MAX_CONNECTIONS", 20))
+WA_MAX_KEEPALIVE = int(os.environ.get("WA_MAX_KEEPALIVE", 10))
+WA_RETRIES = int(os.environ.get("WA_RETRIES", 3))
+# Предохранитель: после WA_BREAKER_THRESHOLD сбоев подряд не ходим в Green-API WA_BREAKER_COOLDOWN секунд
+WA_BREAKER_THRESHOLD = int(os.environ.get("WA_BREAKER_THRESHOLD", 5))
+WA_BREAKER_COOLDOWN = float(os.environ.get("WA_BREAKER_COOLDOWN", 30))
+
+# Роль процесса: telegram — один процесс с сессией Telegram (он же принимает HTTP, как раньше);
+# api — только HTTP, отправки передаются Telegram-воркеру через таблицу jobs в общей БД
+ROLE_TELEGRAM, ROLE_API = "telegram", "api"
+APP_ROLE = os.environ.get('APP_ROLE', ROLE_TELEGRAM)
+PORT = int(os.environ.get('PORT', 5000))
+API_WORKERS = int(os.environ.get('API_WORKERS', 1))
+
+# Очередь заданий API -> Telegram-воркер: период опроса (мс), сколько заданий воркер выполняет разом,
+# сколько API ждет результата до ответа 202 и сколько часов хранить выполненные задания
+JOB_POLL_MS = int(os.environ.get('JOB_POLL_MS', 50))
+JOB_CONCURRENCY = int(os.environ.get('JOB_CONCURRENCY', 50))
+JOB_WAIT_TIMEOUT = float(os.environ.get('JOB_WAIT_TIMEOUT', 120))
+JOB_KEEP_HOURS = int(os.environ.get('JOB_KEEP_HOURS', 24))
+# Как часто API-процесс проверяет новые строки outbound_logs, записанные Telegram-воркером
+FEED_POLL_MS = int(os.environ.get('FEED_POLL_MS', 500))
 
 SESSION_PATH = os.environ.get('TG_SESSION_PATH', '/app/data/GenaAPI')
 DB_PATH = os.environ.get('DB_PATH', '/app/data/gateway_messages.db')
-FILES_DIR = '/app/files'
+FILES_DIR = os.environ.get('FILES_DIR', '/app/files')
 BASE_URL = os.environ.get('BASE_URL', 'http://192.168.121.99:5000')
 GROUP_ID = -1003599844429
 
+# Шарды: пары "файл сессии:форум-группа" через запятую — у каждой свой аккаунт (свои лимиты Telegram) и свой форум.
+# Пример: TG_SHARDS=/app/data/GenaAPI:-1003599844429,/app/data/Second:-1001234567890
+# Пусто — одна пара SESSION_PATH:GROUP_ID, как раньше. Раз в SHARD_RELOAD_INTERVAL сек перечитываем итоги rebalance
+TG_SHARDS = os.environ.get('TG_SHARDS', '')
+SHARD_RELOAD_INTERVAL = int(os.environ.get('SHARD_RELOAD_INTERVAL', 60))
+
+# SQLite: один писатель + небольшой пул читателей (WAL позволяет читать во время записи)
+DB_READERS = int(os.environ.get('DB_READERS', 3))
+DB_CACHE_KB = int(os.environ.get('DB_CACHE_KB', 20000))
+
+# Группировка записей в outbound_logs: commit раз в LOG_BATCH_SIZE строк или раз в LOG_FLUSH_MS мс
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', 200))
+LOG_FLUSH_MS = int(os.environ.get('LOG_FLUSH_MS', 50))
+LOG_QUEUE_MAX = int(os.environ.get('LOG_QUEUE_MAX', 10000))
+
+# Курсорная выдача /fetch_new: размер страницы по умолчанию, потолок и порция чтения из БД
+FETCH_LIMIT = int(os.environ.get('FETCH_LIMIT', 500))
+FETCH_LIMIT_MAX = int(os.environ.get('FETCH_LIMIT_MAX', 5000))
+FETCH_CHUNK = 200
+
+# Push-выдача для 1С (/fetch_wait, /fetch_stream): ожидание long-poll и интервал пинга SSE, сек
+FEED_WAIT_DEFAULT = float(os.environ.get('FEED_WAIT_DEFAULT', 25))
+FEED_WAIT_MAX = float(os.environ.get('FEED_WAIT_MAX', 55))
+FEED_PING_INTERVAL = float(os.environ.get('FEED_PING_INTERVAL', 15))
+
+# Сколько записей client_topics держать в памяти (клиент <-> тема)
+TOPIC_CACHE_SIZE = int(os.environ.get('TOPIC_CACHE_SIZE', 50000))
+
+# Проверка живости тем в фоне: через сколько секунд тема считается непроверенной,
+# как часто запускать проверку и сколько тем проверять за один проход
+TOPIC_TTL = int(os.environ.get('TOPIC_TTL', 6 * 3600))
+TOPIC_CHECK_INTERVAL = int(os.environ.get('TOPIC_CHECK_INTERVAL', 300))
+TOPIC_CHECK_MAX = int(os.environ.get('TOPIC_CHECK_MAX', 500))
+
+# Подключение к Telegram: сколько секунд API ждет готовности клиента и пределы паузы между переподключениями
+TG_READY_TIMEOUT = float(os.environ.get('TG_READY_TIMEOUT', 10))
+TG_RECONNECT_MIN = float(os.environ.get('TG_RECONNECT_MIN', 1))
+TG_RECONNECT_MAX = float(os.environ.get('TG_RECONNECT_MAX', 60))
+
+# Окно (мс), за которое удаления тем из Telegram копятся и пишутся в БД одним запросом
+TOPIC_DELETE_WINDOW_MS = int(os.environ.get('TOPIC_DELETE_WINDOW_MS', 200))
+
+# Окно (мс) сборки альбома менеджера: части с общим grouped_id приходят отдельными апдейтами почти одновременно
+ALBUM_WINDOW_MS = int(os.environ.get('ALBUM_WINDOW_MS', 500))
+
+# Планировщик отправки: число воркеров, лимиты (сообщений в секунду / размер всплеска)
+# на весь аккаунт, на одного получателя и на нашу форум-группу, повторы после FloodWait
+SEND_WORKERS = int(os.environ.get('SEND_WORKERS', 4))
+TG_GLOBAL_RATE = float(os.environ.get('TG_GLOBAL_RATE', 20))
+TG_GLOBAL_BURST = float(os.environ.get('TG_GLOBAL_BURST', 30))
+TG_PEER_RATE = float(os.environ.get('TG_PEER_RATE', 1))
+TG_PEER_BURST = float(os.environ.get('TG_PEER_BURST', 3))
+TG_GROUP_RATE = float(os.environ.get('TG_GROUP_RATE', 5))
+TG_GROUP_BURST = float(os.environ.get('TG_GROUP_BURST', 20))
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 3))
+SEND_FLOOD_MAX_WAIT = int(os.environ.get('SEND_FLOOD_MAX_WAIT', 300))
+
+# /send_batch: сколько получателей обрабатывать одновременно и максимум получателей в запросе
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 20))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 10000))
+
+# Сколько секунд помнить, что номер не найден в Telegram (чтобы не дергать ResolvePhone повторно)
+ENTITY_NEGATIVE_TTL = int(os.environ.get('ENTITY_NEGATIVE_TTL', 24 * 3600))
+
+# Файлы /send_file по URL: сколько секунд не перепроверять URL вовсе и таймаут скачивания
+MEDIA_REVALIDATE = int(os.environ.get('MEDIA_REVALIDATE', 300))
+MEDIA_DOWNLOAD_TIMEOUT = float(os.environ.get('MEDIA_DOWNLOAD_TIMEOUT', 120))
+
+# Хранилище вложений (FILES_DIR/store): потолок по объему, максимальный возраст и период уборки
+MEDIA_STORE_MAX_BYTES = int(os.environ.get('MEDIA_STORE_MAX_BYTES', 10 * 1024 ** 3))
+MEDIA_MAX_AGE_DAYS = int(os.environ.get('MEDIA_MAX_AGE_DAYS', 90))
+MEDIA_SWEEP_INTERVAL = int(os.environ.get('MEDIA_SWEEP_INTERVAL', 300))
+
+# Отдача /get_file: размер куска чтения (у Quart по умолчанию 8 КБ — по заходу в поток на каждый кусок)
+# и сколько клиенты кэшируют файл (имена — uuid, содержимое по ссылке не меняется)
+FILE_BUFFER_SIZE = int(os.environ.get('FILE_BUFFER_SIZE', 256 * 1024))
+FILE_CACHE_MAX_AGE = int(os.environ.get('FILE_CACHE_MAX_AGE', 365 * 24 * 3600))
+
 mgr_raw = os.environ.get('MANAGERS_PHONES', '')
 MANAGERS = {}
 if mgr_raw:
@@ -31,101 +140,1620 @@ if mgr_raw:
 
 if not os.path.exists(FILES_DIR): os.makedirs(FILES_DIR)
 
-client = None
+# --- МЕТРИКИ ---
+# Границы корзин гистограмм задержек, сек: от миллисекунды (SQLite) до десятков секунд (загрузка файлов)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
-async def get_client():
-    global client
-    if client is None:
-        # Убедись, что SESSION_PATH ведет на GenaAPI без папок, если файл лежит в корне
-        client = TelegramClient(SESSION_PATH, API_ID, API_HASH)
-    
-    if not client.is_connected():
-        await client.connect()
+class Histogram:
+    """Гистограмма с фиксированными корзинами, как в Prometheus: число замеров по корзинам, сумма и количество"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # Замер, равный границе, попадает в ее корзину (le — "меньше или равно")
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Метрики процесса в памяти: задержки этапов и счетчики; /metrics отдает их в текстовом формате Prometheus"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.stages = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        hist = self.stages.get(stage)
+        if hist is None:
+            hist = self.stages[stage] = Histogram(self.buckets)
+        hist.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        # Замер идет и при исключении: медленные ошибки тоже должны быть видны
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    async def timed(self, stage, awaitable):
+        # То же, что timer, для лямбд, где with не написать
+        with self.timer(stage):
+            return await awaitable
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+    def render(self, families):
+        # families: (имя, тип, описание, [(метки, значение), ...]) — счетчики и датчики, собранные при запросе
+        lines = [
+            "# HELP tg1c_stage_seconds Latency of hot-path stages",
+            "# TYPE tg1c_stage_seconds histogram",
+        ]
+        for stage, hist in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), hist.counts):
+                cumulative += count
+                lines.append(f'tg1c_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'tg1c_stage_seconds_sum{{stage="{stage}"}} {hist.sum}')
+            lines.append(f'tg1c_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+        for name, kind, help_text, samples in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(LATENCY_BUCKETS)
+
+# --- DATABASE ---
+class Database:
+    """Долгоживущие соединения с SQLite вместо connect() на каждый вызов"""
+
+    def __init__(self, path, readers=3):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self.writer = None
+        self.readers = None
+        self.write_lock = None
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path, timeout=10)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        await conn.execute("PRAGMA temp_store=MEMORY")
+        await conn.execute("PRAGMA busy_timeout=10000")
+        return conn
+
+    async def open(self):
+        if self.writer is not None:
+            return
+        self.write_lock = asyncio.Lock()
+        self.writer = await self._connect()
+        self.readers = asyncio.Queue()
+        for _ in range(self.readers_count):
+            self.readers.put_nowait(await self._connect())
+        print(f"✅ SQLite открыта (WAL, читателей: {self.readers_count})", flush=True)
+
+    async def close(self):
+        if self.writer is None:
+            return
+        async with self.write_lock:
+            await self.writer.close()
+            self.writer = None
+        while not self.readers.empty():
+            await self.readers.get_nowait().close()
+        print("✅ SQLite закрыта", flush=True)
+
+    @asynccontextmanager
+    async def read(self):
+        # Берем свободное соединение из пула и обязательно возвращаем его обратно
+        conn = await self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        # Один писатель: транзакции не перемешиваются, commit/rollback делаем здесь
+        async with self.write_lock:
+            try:
+                yield self.writer
+                with metrics.timer('sqlite_commit'):
+                    await self.writer.commit()
+            except BaseException:
+                await self.writer.rollback()
+                raise
+
+database = Database(DB_PATH, readers=DB_READERS)
+
+# --- ПОДКЛЮЧЕНИЕ К TELEGRAM ---
+class TelegramNotReady(Exception):
+    pass
+
+class TelegramSupervisor:
+    """Держит TelegramClient одного аккаунта: подключение, авторизация, переподключение с паузой, готовность"""
+
+    def __init__(self, session_path, api_id, api_hash, backoff_min=1, backoff_max=60, shard=None):
+        self.shard = shard
+        self.session_path = session_path
+        self.api_id = api_id
+        self.api_hash = api_hash
+        # Подменяется фейковым клиентом в тестах и бенчмарках
+        self.client_factory = TelegramClient
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.client = None
+        self.authorized = None
+        self.state = "stopped"
+        self.last_error = None
+        self.connected_at = None
+        self.reconnects = 0
+        self.ready = None
+        self.task = None
+
+    def start(self):
+        self.ready = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.client and self.client.is_connected():
+            await self.client.disconnect()
+        self.state = "stopped"
+
+    def is_ready(self):
+        return bool(self.ready and self.ready.is_set() and self.client.is_connected())
+
+    async def wait_ready(self, timeout):
+        if self.is_ready():
+            return True
+        if self.ready is None:
+            return False
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _connect(self):
+        if self.client is None:
+            # Убедись, что SESSION_PATH ведет на GenaAPI без папок, если файл лежит в корне
+            self.client = self.client_factory(self.session_path, self.api_id, self.api_hash)
+            setup_listener(self.client, self.shard)
+        self.state = "connecting"
+        await self.client.connect()
+        # Авторизацию проверяем один раз на подключение, а не на каждый вызов API
+        self.authorized = await self.client.is_user_authorized()
+        if not self.authorized:
+            # start() с вводом телефона не вызываем, чтобы не вешать сервер; ждем, пока подложат сессию
+            await self.client.disconnect()
+            raise TelegramNotReady("Сервер не авторизован: файл .session не найден или не валиден")
+
+    async def _run(self):
+        delay = self.backoff_min
+        while True:
+            try:
+                await self._connect()
+                self.state = "ready"
+                self.last_error = None
+                self.connected_at = datetime.now()
+                delay = self.backoff_min
+                self.ready.set()
+                print(f"✅ [TELEGRAM] {self.session_path}: подключено, слушатель запущен", flush=True)
+                await self.client.run_until_disconnected()
+                self.last_error = "Соединение разорвано"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+            self.ready.clear()
+            self.state = "reconnecting"
+            self.reconnects += 1
+            print(f"❌ [TELEGRAM] {self.session_path}: {self.last_error}. Переподключение через {delay:g} сек", flush=True)
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, self.backoff_max)
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "ready": self.is_ready(),
+            "authorized": self.authorized,
+            "connected_at": self.connected_at,
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+        }
+
+# --- ШАРДЫ (АККАУНТ + ФОРУМ) ---
+class Shard:
+    """Аккаунт Telegram (файл сессии) и его форум-группа с темами клиентов"""
+
+    def __init__(self, session_path, group_id):
+        self.session_path = session_path
+        self.group_id = int(group_id)
+        # В апдейтах удаления канал приходит "голым" id без префикса -100
+        self.channel_id = utils.resolve_id(self.group_id)[0]
+        # False — новых клиентов сюда не назначаем (решает rebalance), старые остаются в своем форуме
+        self.accepting = True
+        self.telegram = TelegramSupervisor(session_path, API_ID, API_HASH, TG_RECONNECT_MIN, TG_RECONNECT_MAX, shard=self)
+
+    def key(self, value):
+        # access_hash и загруженные файлы у каждого аккаунта свои; у исходного аккаунта ключи прежние
+        return str(value) if self.group_id == GROUP_ID else f"{self.group_id}:{value}"
+
+    def stats(self):
+        return dict(self.telegram.stats(), group_id=self.group_id, accepting=self.accepting)
+
+def parse_shards(raw):
+    shards = []
+    for item in raw.split(','):
+        if ':' in item.strip():
+            session_path, group_id = item.strip().rsplit(':', 1)
+            shards.append(Shard(session_path.strip(), group_id.strip()))
+    return shards or [Shard(SESSION_PATH, GROUP_ID)]
+
+class ShardRouter:
+    """Клиент -> шард: group_id его темы из client_topics, для новых клиентов — стабильный хэш по открытым шардам"""
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.default = shards[0]
+        self.by_group = {str(s.group_id): s for s in shards}
+        self.by_channel = {s.channel_id: s for s in shards}
+        self.task = None
+
+    def for_group(self, group_id):
+        # Старые записи без group_id относятся к первому шарду
+        return self.by_group.get(str(group_id), self.default) if group_id else self.default
+
+    def for_new_client(self, client_id):
+        candidates = [s for s in self.shards if s.accepting] or self.shards
+        return candidates[zlib.crc32(str(client_id).encode()) % len(candidates)]
+
+    async def for_client(self, client_id):
+        row = await topic_cache.get_by_client(client_id)
+        return self.for_group(row.get('group_id')) if row else self.for_new_client(client_id)
+
+    async def load(self):
+        async with database.read() as db:
+            async with db.execute("SELECT group_id, accepting FROM shards") as c:
+                for row in await c.fetchall():
+                    shard = self.by_group.get(str(row['group_id']))
+                    if shard:
+                        shard.accepting = bool(row['accepting'])
+
+    async def loads(self):
+        async with database.read() as db:
+            async with db.execute("SELECT group_id, COUNT(*) FROM client_topics GROUP BY group_id") as c:
+                return {str(r[0]): r[1] for r in await c.fetchall()}
+
+    async def _reload(self, interval):
+        # Итоги rebalance, записанные другим процессом (командой или API), подхватываем без перезапуска
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load()
+            except Exception as e:
+                print(f"⚠️ Ошибка чтения настроек шардов: {e}", flush=True)
+
+    def start(self, interval, clients=True):
+        self.task = asyncio.create_task(self._reload(interval))
+        if clients:
+            for shard in self.shards:
+                shard.telegram.start()
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        for shard in self.shards:
+            await shard.telegram.stop()
+
+    async def wait_ready(self, timeout):
+        # Хватает одного готового аккаунта: остальные клиенты получат ошибку своего шарда, а не всего API
+        if any(s.telegram.is_ready() for s in self.shards):
+            return True
+        waiters = [asyncio.ensure_future(s.telegram.wait_ready(timeout)) for s in self.shards]
+        try:
+            for waiter in asyncio.as_completed(waiters):
+                if await waiter:
+                    return True
+            return False
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    def state(self):
+        return [{"group_id": s.group_id, "state": s.telegram.state, "detail": s.telegram.last_error} for s in self.shards]
+
+    def stats(self):
+        return [s.stats() for s in self.shards]
+
+shard_router = ShardRouter(parse_shards(TG_SHARDS))
+
+async def rebalance_shards():
+    # Новых клиентов назначаем только на шарды с нагрузкой не выше средней; старые клиенты не переезжают
+    loads = await shard_router.loads()
+    counts = {s.group_id: loads.get(str(s.group_id), 0) for s in shard_router.shards}
+    average = sum(counts.values()) / len(counts)
+    now = datetime.now()
+    async with database.write() as db:
+        for shard in shard_router.shards:
+            shard.accepting = counts[shard.group_id] <= average
+            await db.execute(
+                "INSERT OR REPLACE INTO shards (group_id, accepting, clients, updated_at) VALUES (?, ?, ?, ?)",
+                (str(shard.group_id), int(shard.accepting), counts[shard.group_id], now)
+            )
+    return [{"group_id": s.group_id, "clients": counts[s.group_id], "accepting": s.accepting} for s in shard_router.shards]
+
+async def get_client(shard=None):
+    shard = shard or shard_router.default
+    if not await shard.telegram.wait_ready(TG_READY_TIMEOUT):
+        raise TelegramNotReady(f"Telegram ({shard.session_path}) недоступен: {shard.telegram.last_error or shard.telegram.state}")
+    return shard.telegram.client
+
+def telegram_unavailable(error):
+    # Клиент шарда не готов: 503 с Retry-After, чтобы 1С повторила запрос позже
+    response = jsonify({"error": str(error), "shards": shard_router.state()})
+    return response, 503, {"Retry-After": str(max(1, int(TG_READY_TIMEOUT)))}
+
+def requires_telegram(view):
+    # Маршрут ждет готовности клиента (без запросов в Telegram) и отвечает 503, если не дождался.
+    # В API-процессе Telegram нет — запрос передается воркеру через очередь заданий
+    @functools.wraps(view)
+    async def wrapper(*args, **kwargs):
+        if APP_ROLE == ROLE_API:
+            return await relay_to_worker()
+        if not await shard_router.wait_ready(TG_READY_TIMEOUT):
+            return telegram_unavailable("Telegram недоступен")
+        return await view(*args, **kwargs)
+    return wrapper
+
+# --- МИГРАЦИИ ---
+# Версия схемы хранится в PRAGMA user_version. Новые шаги добавляем только в конец списка.
+
+async def _add_missing_columns(db, table, columns):
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        existing = {r['name'] for r in await cursor.fetchall()}
+    for name, decl in columns:
+        if name not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+            print(f"🔧 [МИГРАЦИЯ] {table}: добавлена колонка {name}")
+
+async def migrate_v1_base_tables(db):
+    # Таблица логов: добавили topic_id
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS outbound_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT, 
+            phone TEXT, 
+            client_name TEXT, 
+            client_id TEXT,
+            sender_number TEXT, 
+            messenger TEXT DEFAULT 'tg', 
+            message_text TEXT,
+            file_url TEXT, 
+            status TEXT DEFAULT 'pending', 
+            tg_message_id INTEGER,
+            group_id TEXT,
+            topic_id INTEGER, -- Наша новая колонка
+            direction TEXT, 
+            error_text TEXT, 
+            created_at DATETIME, 
+            manager TEXT
+        )
+    """)
     
-    # Проверка: если файл сессии не подхватился, не пытаемся запустить ввод телефона
-    if not await client.is_user_authorized():
-        print("❌ ОШИБКА: Сервер не авторизован. Файл .session не найден или не валиден.")
-        # Здесь мы НЕ вызываем start(), чтобы не вешать сервер
-    return client
+    # Таблица тем: добавили messenger
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS client_topics (
+            client_id TEXT PRIMARY KEY, 
+            topic_id INTEGER,
+            client_name TEXT, 
+            phone TEXT, 
+            manager_ref TEXT,
+            group_id TEXT,
+            messenger TEXT DEFAULT 'tg' -- Наша новая колонка
+        )
+    """)
+
+async def migrate_v2_missing_columns(db):
+    # Старые базы создавались до появления этих колонок — CREATE IF NOT EXISTS их не добавит
+    await _add_missing_columns(db, 'outbound_logs', [
+        ('messenger', "TEXT DEFAULT 'tg'"),
+        ('group_id', 'TEXT'),
+        ('topic_id', 'INTEGER'),
+        ('error_text', 'TEXT'),
+        ('manager', 'TEXT'),
+    ])
+    await _add_missing_columns(db, 'client_topics', [
+        ('manager_ref', 'TEXT'),
+        ('group_id', 'TEXT'),
+        ('messenger', "TEXT DEFAULT 'tg'"),
+    ])
+
+async def migrate_v3_indexes(db):
+    # /fetch_new: частичный индекс только по ожидающим строкам, после выдачи строки из него уходят
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_logs_pending
+        ON outbound_logs(id) WHERE status = 'pending'
+    """)
+    # find_last_outbound_manager: покрывающий индекс, manager читается прямо из индекса
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_logs_client_direction_created
+        ON outbound_logs(client_id, direction, created_at DESC, manager)
+    """)
+    # Все поиски клиента по теме (ответы менеджеров, удаление тем)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_topics_topic_id
+        ON client_topics(topic_id)
+    """)
+
+async def migrate_v4_entity_cache(db):
+    # Кэш разрешения телефона в пользователя Telegram; user_id IS NULL — номер не найден
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS tg_entities (
+            phone TEXT PRIMARY KEY,
+            user_id INTEGER,
+            access_hash INTEGER,
+            name TEXT,
+            resolved_at DATETIME
+        )
+    """)
+
+async def migrate_v5_media_cache(db):
+    # URL файла из 1С -> валидаторы HTTP и хэш содержимого; хэш -> уже загруженный в Telegram документ
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS media_urls (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            sha256 TEXT,
+            checked_at DATETIME
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS media_refs (
+            sha256 TEXT PRIMARY KEY,
+            kind TEXT,
+            media_id INTEGER,
+            access_hash INTEGER,
+            file_reference BLOB,
+            file_name TEXT,
+            uploaded_at DATETIME
+        )
+    """)
+
+async def migrate_v6_tg_media(db):
+    # Вложения менеджеров: где лежит файл в Telegram, скачиваем его только по первому запросу /get_file
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS tg_media (
+            filename TEXT PRIMARY KEY,
+            chat_id INTEGER,
+            message_id INTEGER,
+            mime_type TEXT,
+            size INTEGER,
+            created_at DATETIME
+        )
+    """)
+
+async def migrate_v7_media_store(db):
+    # Файлы на диске адресуются хэшем содержимого; last_access нужен для вытеснения без обхода каталогов
+    await _add_missing_columns(db, 'tg_media', [('sha256', 'TEXT')])
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS media_blobs (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT,
+            size INTEGER,
+            created_at DATETIME,
+            last_access DATETIME
+        )
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_media_blobs_last_access
+        ON media_blobs(last_access)
+    """)
+
+async def migrate_v8_jobs(db):
+    # Задания от API-процессов Telegram-воркеру (APP_ROLE=api)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT,
+            payload TEXT,
+            status TEXT,
+            http_status INTEGER,
+            result TEXT,
+            created_at DATETIME,
+            started_at DATETIME,
+            finished_at DATETIME
+        )
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_queued
+        ON jobs(created_at) WHERE status = 'queued'
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_finished_at
+        ON jobs(finished_at)
+    """)
+
+async def migrate_v9_shards(db):
+    # Старые темы живут в исходном форуме; rebalance хранит, какие шарды принимают новых клиентов
+    await db.execute("UPDATE client_topics SET group_id = ? WHERE group_id IS NULL OR group_id = ''", (str(GROUP_ID),))
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_topics_group_topic
+        ON client_topics(group_id, topic_id)
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS shards (
+            group_id TEXT PRIMARY KEY,
+            accepting INTEGER,
+            clients INTEGER,
+            updated_at DATETIME
+        )
+    """)
+
+MIGRATIONS = [
+    (1, migrate_v1_base_tables),
+    (2, migrate_v2_missing_columns),
+    (3, migrate_v3_indexes),
+    (4, migrate_v4_entity_cache),
+    (5, migrate_v5_media_cache),
+    (6, migrate_v6_tg_media),
+    (7, migrate_v7_media_store),
+    (8, migrate_v8_jobs),
+    (9, migrate_v9_shards),
+]
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Таблица логов: добавили topic_id
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS outbound_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                source TEXT, 
-                phone TEXT, 
-                client_name TEXT, 
-                client_id TEXT,
-                sender_number TEXT, 
-                messenger TEXT DEFAULT 'tg', 
-                message_text TEXT,
-                file_url TEXT, 
-                status TEXT DEFAULT 'pending', 
-                tg_message_id INTEGER,
-                group_id TEXT,
-                topic_id INTEGER, -- Наша новая колонка
-                direction TEXT, 
-                error_text TEXT, 
-                created_at DATETIME, 
-                manager TEXT
-            )
-        """)
-        
-        # Таблица тем: добавили messenger
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS client_topics (
-                client_id TEXT PRIMARY KEY, 
-                topic_id INTEGER,
-                client_name TEXT, 
-                phone TEXT, 
-                manager_ref TEXT,
-                group_id TEXT,
-                messenger TEXT DEFAULT 'tg' -- Наша новая колонка
-            )
-        """)
-        await db.commit()
-        print("✅ База данных (структура) актуализирована")
+    async with database.read() as db:
+        async with db.execute("PRAGMA user_version") as cursor:
+            version = (await cursor.fetchone())[0]
+
+    for target, migrate in MIGRATIONS:
+        if target <= version:
+            continue
+        # Каждый шаг — отдельная транзакция вместе с новым user_version.
+        # IMMEDIATE + повторная проверка: несколько процессов могут стартовать одновременно
+        async with database.write() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            async with db.execute("PRAGMA user_version") as cursor:
+                version = (await cursor.fetchone())[0]
+            if target <= version:
+                continue
+            await migrate(db)
+            await db.execute(f"PRAGMA user_version = {target}")
+        version = target
+        print(f"🔧 [МИГРАЦИЯ] Схема БД обновлена до версии {target}")
+
+    print("✅ База данных (структура) актуализирована")
+
+LOG_INSERT_SQL = """
+    INSERT INTO outbound_logs 
+    (source, phone, client_name, client_id, manager, sender_number, messenger, message_text, file_url, status, direction, tg_message_id, topic_id, group_id, created_at) 
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+class LogWriter:
+    """Write-behind очередь для outbound_logs: много строк — одна транзакция (один fsync)"""
+
+    def __init__(self, batch_size=200, flush_ms=50, max_queue=10000):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_ms / 1000
+        self.max_queue = max_queue
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        # Очередь создаем уже внутри работающего event loop
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Стоп-маркер встает в конец очереди, поэтому все, что было до него, будет записано
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+        print("✅ Очередь логов сброшена на диск", flush=True)
+
+    async def put(self, row, wait=False):
+        # Если очередь заполнена — ждем (backpressure), а не копим строки в памяти без конца
+        fut = asyncio.get_running_loop().create_future() if wait else None
+        await self.queue.put((row, fut))
+        if fut is not None:
+            return await fut
+
+    async def _collect(self, first):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        batch, stop = [first], False
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        return batch, stop
+
+    async def _run(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            batch, stop = await self._collect(item)
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def _flush(self, batch):
+        ids = [None] * len(batch)
+        try:
+            async with database.write() as db:
+                if any(fut is not None for _, fut in batch):
+                    # Кто-то ждет id строки — вставляем по одной, но все равно в одной транзакции
+                    for i, (row, _) in enumerate(batch):
+                        cursor = await db.execute(LOG_INSERT_SQL, row)
+                        ids[i] = cursor.lastrowid
+                else:
+                    await db.executemany(LOG_INSERT_SQL, [row for row, _ in batch])
+                async with db.execute("SELECT last_insert_rowid()") as cursor:
+                    last_id = (await cursor.fetchone())[0]
+        except Exception as e:
+            print(f"⚠️ DB Error (log_to_db): {e} (потеряно строк: {len(batch)})", flush=True)
+            last_id = None
+        if last_id:
+            change_feed.notify(last_id)
+        for (_, fut), row_id in zip(batch, ids):
+            if fut is not None and not fut.done():
+                fut.set_result(row_id)
+
+class ChangeFeed:
+    """Сигнал в памяти о новых строках outbound_logs: ожидающие запросы 1С не опрашивают БД"""
+
+    def __init__(self):
+        self.last_id = 0
+        self._event = None
+        self.task = None
+
+    def start(self, last_id):
+        self.last_id = last_id or 0
+        self._event = asyncio.Event()
+
+    def start_polling(self, interval):
+        # Строки пишет другой процесс (Telegram-воркер) — сигнала в памяти нет, раз в interval смотрим MAX(id)
+        self.task = asyncio.create_task(self._poll(interval))
+
+    async def _poll(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with database.read() as db:
+                    async with db.execute("SELECT MAX(id) FROM outbound_logs") as c:
+                        last_id = (await c.fetchone())[0]
+                if last_id and last_id > self.last_id:
+                    self.notify(last_id)
+            except Exception as e:
+                print(f"⚠️ Ошибка опроса новых сообщений: {e}", flush=True)
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def notify(self, last_id=None):
+        if last_id and last_id > self.last_id:
+            self.last_id = last_id
+        # Будим всех текущих ждущих и заводим новое событие для следующих
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def wait(self, seen_id, timeout):
+        # True — в БД есть строки новее seen_id (или пришел сигнал), False — вышел таймаут
+        event = self._event
+        if self.last_id > seen_id:
+            return True
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.last_id > seen_id
+
+change_feed = ChangeFeed()
+
+log_writer = LogWriter(LOG_BATCH_SIZE, LOG_FLUSH_MS, LOG_QUEUE_MAX)
 
 async def log_to_db(source, phone, text, c_name=None, c_id=None, manager_fio=None, 
                     s_number=None, f_url=None, direction="out", tg_id=None, 
-                    status="ok", error="", topic_id=None, group_id=None, messenger='tg'):
+                    status="ok", error="", topic_id=None, group_id=None, messenger='tg',
+                    wait=False):
+    # wait=True — дождаться записи на диск и получить id строки (None при ошибке)
     
     created_at = datetime.now()
     # Если group_id не передан явно, используем дефолтный из констант
     g_id = str(group_id or GROUP_ID)
     
+    row = (
+        str(source), 
+        str(phone or ""), 
+        str(c_name or ""), 
+        str(c_id or ""), 
+        str(manager_fio or ""), 
+        str(s_number or ""), 
+        str(messenger), 
+        str(text or ""), 
+        f_url, 
+        'pending', 
+        direction, 
+        tg_id, 
+        topic_id, 
+        g_id, # Добавили ID группы в логи
+        created_at
+    )
     try:
-        async with aiosqlite.connect(DB_PATH, timeout=10) as db:
-            await db.execute("""
-                INSERT INTO outbound_logs 
-                (source, phone, client_name, client_id, manager, sender_number, messenger, message_text, file_url, status, direction, tg_message_id, topic_id, group_id, created_at) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                str(source), 
-                str(phone or ""), 
-                str(c_name or ""), 
-                str(c_id or ""), 
-                str(manager_fio or ""), 
-                str(s_number or ""), 
-                str(messenger), 
-                str(text or ""), 
-                f_url, 
-                'pending', 
-                direction, 
-                tg_id, 
-                topic_id, 
-                g_id, # Добавили ID группы в логи
-                created_at
-            ))
-            await db.commit()
+        return await log_writer.put(row, wait=wait)
     except Exception as e: 
         print(f"⚠️ DB Error (log_to_db): {e}")
 
-async def create_new_topic(client_id, client_name, messenger='tg'):
+# --- ПЛАНИРОВЩИК ОТПРАВКИ В TELEGRAM ---
+# Полосы приоритета: чем меньше число, тем раньше уходит сообщение
+PRIORITY_LIVE = 0     # ответы менеджеров клиентам
+PRIORITY_NORMAL = 1   # одиночные /send, /send_file из 1С
+PRIORITY_BULK = 2     # массовые рассылки
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        # Сколько секунд ждать до появления жетона (0 — можно сразу)
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class SendJob:
+    def __init__(self, peer, factory, priority, account=None):
+        self.id = uuid.uuid4().hex
+        self.peer = peer
+        self.account = account
+        self.factory = factory
+        self.priority = priority
+        self.status = "queued"
+        self.attempts = 0
+        self.error = None
+        self.result = None
+        self.created_at = datetime.now()
+        self.finished_at = None
+        self.future = asyncio.get_running_loop().create_future()
+        # Ошибку читают через /jobs или await — не даем asyncio ругаться на "never retrieved"
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    async def wait(self):
+        # shield: отмена HTTP-запроса не отменяет уже поставленную отправку
+        return await asyncio.shield(self.future)
+
+    def info(self):
+        result = self.result if isinstance(self.result, (dict, list, str, int, float, type(None))) else str(self.result)
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "attempts": self.attempts,
+            "error": self.error,
+            "result": result,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+class SendScheduler:
+    """Очередь отправок в Telegram: token bucket на аккаунт и на получателя, повтор после FloodWait"""
+
+    def __init__(self, workers=4, history=10000):
+        self.workers_count = max(1, workers)
+        self.history = history
+        # Лимиты и FloodWait у каждого аккаунта (шарда) свои; account — group_id шарда
+        self.account_buckets = {}
+        self.peer_buckets = {}
+        self.jobs = OrderedDict()
+        self.queue = None
+        self.workers = []
+        self.seq = 0
+        self.paused_until = {}
+        self.blocked_until = {}
+        self.flood_waits = 0
+        self.done = 0
+        self.failed = 0
+
+    def start(self):
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+
+    async def stop(self):
+        for w in self.workers:
+            w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def _peer_bucket(self, peer):
+        bucket = self.peer_buckets.get(peer)
+        if bucket is None:
+            if len(self.peer_buckets) > 10000:
+                # Полные корзины ничего не помнят — их можно выбросить
+                self.peer_buckets = {p: b for p, b in self.peer_buckets.items() if not b.is_full()}
+            if str(peer) in shard_router.by_group:
+                bucket = TokenBucket(TG_GROUP_RATE, TG_GROUP_BURST)
+            else:
+                bucket = TokenBucket(TG_PEER_RATE, TG_PEER_BURST)
+            self.peer_buckets[peer] = bucket
+        return bucket
+
+    def _enqueue(self, job):
+        self.seq += 1
+        self.queue.put_nowait((job.priority, self.seq, job))
+
+    def submit(self, peer, factory, priority=PRIORITY_NORMAL, account=None):
+        # factory — функция без аргументов, возвращающая корутину с самим вызовом Telethon
+        job = SendJob(peer, factory, priority, account)
+        self._register(job)
+        self._enqueue(job)
+        return job
+
+    async def run(self, peer, factory, priority=PRIORITY_NORMAL, account=None):
+        return await self.submit(peer, factory, priority, account).wait()
+
+    async def call(self, peer, factory, account=None):
+        # Вызов без очереди, в задаче вызывающего (создание темы бывает и внутри задачи отправки — через очередь
+        # воркеры ждали бы сами себя): те же корзины и пауза аккаунта, повтор после короткого FloodWait
+        attempts = 0
+        while True:
+            blocked = self.blocked_until.get(account, 0) - time.monotonic()
+            if blocked > 0:
+                # Долгий FloodWait: не дергаем Telegram, пока он не закончится
+                raise errors.FloodWaitError(request=None, capture=int(blocked) + 1)
+            await self._acquire(peer, account)
+            attempts += 1
+            try:
+                return await factory()
+            except errors.FloodWaitError as e:
+                self.flood_waits += 1
+                if e.seconds > SEND_FLOOD_MAX_WAIT:
+                    self.blocked_until[account] = time.monotonic() + e.seconds
+                    raise
+                if attempts > SEND_MAX_RETRIES:
+                    raise
+                print(f"⏳ FloodWait {e.seconds} сек, вызов для {peer} будет повторен", flush=True)
+                self.paused_until[account] = max(self.paused_until.get(account, 0), time.monotonic() + e.seconds + 1)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _register(self, job):
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.history:
+            self.jobs.popitem(last=False)
+
+    def spawn(self, factory):
+        # Составная фоновая задача (пакет /send_batch): сама в очередь не встает, видна через /jobs
+        job = SendJob(None, factory, PRIORITY_BULK)
+        job.status = "running"
+        self._register(job)
+
+        async def runner():
+            try:
+                result = await factory(job)
+            except Exception as e:
+                self._finish(job, error=e, count=False)
+            else:
+                self._finish(job, result=result, count=False)
+
+        asyncio.ensure_future(runner())
+        return job
+
+    def _account_bucket(self, account):
+        bucket = self.account_buckets.get(account)
+        if bucket is None:
+            bucket = self.account_buckets[account] = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_BURST)
+        return bucket
+
+    async def _acquire(self, peer, account=None):
+        account_bucket = self._account_bucket(account)
+        bucket = self._peer_bucket(peer)
+        while True:
+            paused = self.paused_until.get(account, 0) - time.monotonic()
+            delay = max(account_bucket.delay(), bucket.delay(), paused)
+            if delay <= 0:
+                account_bucket.take()
+                bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    def _finish(self, job, result=None, error=None, count=True):
+        job.finished_at = datetime.now()
+        if error is None:
+            job.status, job.result = "done", result
+            self.done += count
+            if not job.future.done():
+                job.future.set_result(result)
+        else:
+            job.status, job.error = "failed", str(error)
+            self.failed += count
+            if not job.future.done():
+                job.future.set_exception(error)
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self.queue.get()
+            await self._acquire(job.peer, job.account)
+            job.status = "running"
+            job.attempts += 1
+            try:
+                result = await job.factory()
+            except errors.FloodWaitError as e:
+                self.flood_waits += 1
+                if e.seconds > SEND_FLOOD_MAX_WAIT or job.attempts > SEND_MAX_RETRIES:
+                    self._finish(job, error=e)
+                    continue
+                # FloodWait действует на весь аккаунт — притормаживаем все воркеры, а задачу возвращаем в очередь
+                print(f"⏳ FloodWait {e.seconds} сек, задача {job.id} будет повторена", flush=True)
+                self.paused_until[job.account] = max(self.paused_until.get(job.account, 0), time.monotonic() + e.seconds + 1)
+                job.status = "waiting"
+                self._enqueue(job)
+            except Exception as e:
+                self._finish(job, error=e)
+            else:
+                self._finish(job, result=result)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "workers": len(self.workers),
+            "paused_for": max([0] + [round(t - time.monotonic(), 1) for t in self.paused_until.values()]),
+            "blocked_for": max([0] + [round(t - time.monotonic(), 1) for t in self.blocked_until.values()]),
+            "done": self.done,
+            "failed": self.failed,
+            "flood_waits": self.flood_waits,
+        }
+
+send_scheduler = SendScheduler(SEND_WORKERS)
+
+# --- КЭШ ТЕМ ---
+class TopicCache:
+    """Кэш client_topics в памяти в обе стороны: client_id -> строка и (group_id, topic_id) -> client_id"""
+
+    def __init__(self, max_size=50000):
+        self.max_size = max(1, max_size)
+        self.by_client = OrderedDict()
+        self.by_topic = {}
+        # complete=True — в памяти вся таблица, промах означает "записи точно нет" без похода в БД
+        self.complete = False
+        self.hits = 0
+        self.misses = 0
+
+    async def warm(self):
+        async with database.read() as db:
+            async with db.execute("SELECT * FROM client_topics ORDER BY rowid DESC LIMIT ?", (self.max_size + 1,)) as c:
+                rows = [dict(r) for r in await c.fetchall()]
+        self.by_client.clear()
+        self.by_topic.clear()
+        for row in reversed(rows[:self.max_size]):
+            self._store(row)
+        self.complete = len(rows) <= self.max_size
+        print(f"✅ Кэш тем прогрет: {len(self.by_client)} записей", flush=True)
+
+    @staticmethod
+    def topic_key(group_id, topic_id):
+        # ID тем уникальны только внутри своего форума
+        return (str(group_id or GROUP_ID), topic_id)
+
+    @classmethod
+    def _row_topic_key(cls, row):
+        return cls.topic_key(row.get('group_id'), row.get('topic_id'))
+
+    def _store(self, row):
+        client_id = str(row['client_id'])
+        old = self.by_client.pop(client_id, None)
+        if old and old.get('topic_id') is not None:
+            self.by_topic.pop(self._row_topic_key(old), None)
+        self.by_client[client_id] = row
+        if row.get('topic_id') is not None:
+            self.by_topic[self._row_topic_key(row)] = client_id
+        while len(self.by_client) > self.max_size:
+            _, evicted = self.by_client.popitem(last=False)
+            self.by_topic.pop(self._row_topic_key(evicted), None)
+            self.complete = False
+
+    def put(self, row):
+        self._store(dict(row))
+
+    def drop_client(self, client_id):
+        row = self.by_client.pop(str(client_id), None)
+        if row:
+            self.by_topic.pop(self._row_topic_key(row), None)
+
+    def drop_topic(self, group_id, topic_id):
+        client_id = self.by_topic.pop(self.topic_key(group_id, topic_id), None)
+        if client_id is not None:
+            self.by_client.pop(client_id, None)
+
+    async def get_by_client(self, client_id):
+        client_id = str(client_id)
+        row = self.by_client.get(client_id)
+        if row is not None or self.complete:
+            self.hits += 1
+            if row is not None:
+                self.by_client.move_to_end(client_id)
+            return dict(row) if row else None
+        self.misses += 1
+        async with database.read() as db:
+            async with db.execute("SELECT * FROM client_topics WHERE client_id = ?", (client_id,)) as c:
+                found = await c.fetchone()
+        if not found:
+            return None
+        self.put(found)
+        return dict(found)
+
+    async def get_many_by_client(self, client_ids):
+        # Пакетный вариант get_by_client: недостающее добираем одним IN (...) на порцию
+        found, missing = {}, []
+        for client_id in {str(c) for c in client_ids}:
+            row = self.by_client.get(client_id)
+            if row is not None:
+                found[client_id] = dict(row)
+            elif not self.complete:
+                missing.append(client_id)
+        self.hits += len(found)
+        self.misses += len(missing)
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            async with database.read() as db:
+                async with db.execute(
+                    f"SELECT * FROM client_topics WHERE client_id IN ({','.join(['?'] * len(chunk))})", chunk
+                ) as c:
+                    for row in await c.fetchall():
+                        self.put(row)
+                        found[row['client_id']] = dict(row)
+        return found
+
+    def may_have_topic(self, group_id, topic_id):
+        # Без похода в БД: при полном кэше незнакомый topic_id точно не наш
+        return self.topic_key(group_id, topic_id) in self.by_topic or not self.complete
+
+    async def get_by_topic(self, group_id, topic_id):
+        client_id = self.by_topic.get(self.topic_key(group_id, topic_id))
+        if client_id is not None or self.complete:
+            self.hits += 1
+            if client_id is None:
+                return None
+            self.by_client.move_to_end(client_id)
+            return dict(self.by_client[client_id])
+        self.misses += 1
+        async with database.read() as db:
+            async with db.execute(
+                "SELECT * FROM client_topics WHERE group_id = ? AND topic_id = ?", self.topic_key(group_id, topic_id)
+            ) as c:
+                found = await c.fetchone()
+        if not found:
+            return None
+        self.put(found)
+        return dict(found)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.by_client),
+            "max_size": self.max_size,
+            "complete": self.complete,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+        }
+
+topic_cache = TopicCache(TOPIC_CACHE_SIZE)
+
+# Ошибки Telegram, означающие, что темы (ее стартового сообщения) больше нет
+TOPIC_GONE_ERRORS = (errors.TopicDeletedError, errors.MsgIdInvalidError)
+
+class TopicLiveness:
+    """Живость тем без RPC на каждую отправку: TTL + события удаления + пакетная фоновая проверка"""
+
+    def __init__(self, ttl, interval, max_per_run, batch=100):
+        self.ttl = ttl
+        self.interval = interval
+        self.max_per_run = max_per_run
+        self.batch = batch
+        self.checked = {}
+        self.started = time.monotonic()
+        self.task = None
+
+    def mark_alive(self, group_id, topic_id):
+        if topic_id is not None:
+            self.checked[topic_cache.topic_key(group_id, topic_id)] = time.monotonic()
+
+    def stale(self):
+        now = time.monotonic()
+        known = topic_cache.by_topic
+        # Удаленные из кэша темы больше не отслеживаем
+        for key in [k for k in self.checked if k not in known]:
+            del self.checked[key]
+        # Темы из БД без отметки считаем проверенными в момент старта, иначе все они станут "старыми" сразу
+        due = [k for k in known if now - self.checked.get(k, self.started) > self.ttl]
+        due.sort(key=lambda k: self.checked.get(k, self.started))
+        return due[:self.max_per_run]
+
+    async def validate_once(self):
+        due = self.stale()
+        if not due:
+            return
+        by_group = {}
+        for group_id, topic_id in due:
+            by_group.setdefault(group_id, []).append(topic_id)
+        gone = []
+        for group_id, topic_ids in by_group.items():
+            shard = shard_router.for_group(group_id)
+            tg = await get_client(shard)
+            for i in range(0, len(topic_ids), self.batch):
+                chunk = topic_ids[i:i + self.batch]
+                # Один get_messages на пачку id; для отсутствующих Telethon возвращает None
+                msgs = await tg.get_messages(shard.group_id, ids=chunk)
+                for topic_id, msg in zip(chunk, msgs):
+                    if not msg or isinstance(msg, types.MessageEmpty):
+                        gone.append((group_id, topic_id))
+                    else:
+                        self.mark_alive(group_id, topic_id)
+        for group_id, topic_id in gone:
+            await forget_topic(group_id, topic_id)
+        print(f"🔎 Проверено тем: {len(due)}, удалено из базы: {len(gone)}", flush=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.validate_once()
+            except Exception as e:
+                print(f"⚠️ Ошибка фоновой проверки тем: {e}", flush=True)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+topic_liveness = TopicLiveness(TOPIC_TTL, TOPIC_CHECK_INTERVAL, TOPIC_CHECK_MAX)
+
+class TopicDeletions:
+    """Удаления тем копятся коротким окном и пишутся одним DELETE ... IN (...) вместо запроса на каждый id"""
+
+    def __init__(self, window_ms=200):
+        self.window = window_ms / 1000
+        self.pending = set()
+        self.task = None
+        self.deleted = 0
+
+    def add(self, group_id, topic_ids):
+        self.pending.update(topic_cache.topic_key(group_id, t) for t in topic_ids)
+        if self.pending and self.task is None:
+            self.task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self.task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"⚠️ Ошибка удаления тем из БД: {e}", flush=True)
+
+    async def flush(self):
+        keys, self.pending = self.pending, set()
+        if not keys:
+            return
+        by_group = {}
+        for group_id, topic_id in keys:
+            by_group.setdefault(group_id, []).append(topic_id)
+        removed = 0
+        async with database.write() as db:
+            for group_id, topic_ids in by_group.items():
+                for i in range(0, len(topic_ids), 500):
+                    chunk = topic_ids[i:i + 500]
+                    cursor = await db.execute(
+                        f"DELETE FROM client_topics WHERE group_id = ? AND topic_id IN ({','.join(['?'] * len(chunk))})",
+                        [group_id] + chunk
+                    )
+                    removed += cursor.rowcount
+        for group_id, topic_id in keys:
+            topic_cache.drop_topic(group_id, topic_id)
+        self.deleted += removed
+        if removed:
+            print(f"✅ [БАЗА] Удалено тем из БД: {removed}", flush=True)
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+topic_deletions = TopicDeletions(TOPIC_DELETE_WINDOW_MS)
+
+async def forget_topic(group_id, topic_id):
+    async with database.write() as db:
+        await db.execute("DELETE FROM client_topics WHERE group_id = ? AND topic_id = ?", topic_cache.topic_key(group_id, topic_id))
+    topic_cache.drop_topic(group_id, topic_id)
+    print(f"🗑️ [БАЗА] Тема {topic_id} больше не существует, запись удалена", flush=True)
+
+# --- КЭШ ПОЛЬЗОВАТЕЛЕЙ TELEGRAM ---
+# Ошибки, после которых сохраненный access_hash больше не годится — разрешаем номер заново
+PEER_INVALID_ERRORS = (errors.PeerIdInvalidError, errors.UserIdInvalidError, errors.UserInvalidError)
+
+class ResolvedUser:
+    def __init__(self, user_id, access_hash, name):
+        self.id = user_id
+        self.access_hash = access_hash
+        self.first_name = name
+
+    @property
+    def input_peer(self):
+        return types.InputPeerUser(self.id, self.access_hash)
+
+class EntityCache:
+    """Телефон -> (user_id, access_hash) в SQLite и в памяти: отправка без get_entity на каждый вызов"""
+
+    def __init__(self, negative_ttl):
+        self.negative_ttl = negative_ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.resolving = {}
+
+    @staticmethod
+    def _key(phone):
+        return str(phone).lstrip('+').strip()
+
+    async def load(self):
+        async with database.read() as db:
+            async with db.execute("SELECT * FROM tg_entities") as c:
+                self.entries = {r['phone']: dict(r) for r in await c.fetchall()}
+        print(f"✅ Кэш пользователей Telegram загружен: {len(self.entries)} записей", flush=True)
+
+    def _fresh_negative(self, entry):
+        try:
+            resolved_at = datetime.fromisoformat(str(entry['resolved_at']))
+        except ValueError:
+            return False
+        return (datetime.now() - resolved_at).total_seconds() < self.negative_ttl
+
+    async def _store(self, key, user_id, access_hash, name):
+        entry = {"phone": key, "user_id": user_id, "access_hash": access_hash, "name": name, "resolved_at": datetime.now()}
+        async with database.write() as db:
+            await db.execute("""
+                INSERT OR REPLACE INTO tg_entities (phone, user_id, access_hash, name, resolved_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (key, user_id, access_hash, name, entry['resolved_at']))
+        self.entries[key] = entry
+        return entry
+
+    async def resolve(self, phone, refresh=False, shard=None):
+        shard = shard or shard_router.default
+        phone = self._key(phone)
+        key = shard.key(phone)
+        entry = None if refresh else self.entries.get(key)
+        if entry is not None and (entry['user_id'] is not None or self._fresh_negative(entry)):
+            self.hits += 1
+        else:
+            self.misses += 1
+            # Одновременные запросы одного номера делают один ResolvePhone
+            task = self.resolving.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._fetch(key, phone, shard))
+                self.resolving[key] = task
+                task.add_done_callback(lambda _: self.resolving.pop(key, None))
+            entry = await asyncio.shield(task)
+        if entry['user_id'] is None:
+            raise ValueError(f'Cannot find any entity corresponding to "{phone}"')
+        return ResolvedUser(entry['user_id'], entry['access_hash'], entry['name'])
+
+    async def _fetch(self, key, phone, shard):
+        tg = await get_client(shard)
+        try:
+            ent = await tg.get_entity(phone)
+        except ValueError:
+            print(f"ℹ️ Номер {phone} не найден в Telegram, запомнил", flush=True)
+            return await self._store(key, None, None, None)
+        if not isinstance(ent, types.User):
+            raise ValueError(f"{phone} — не пользователь, а {type(ent).__name__}")
+        return await self._store(key, ent.id, ent.access_hash, ent.first_name or '')
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "negative": sum(1 for e in self.entries.values() if e['user_id'] is None),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+entity_cache = EntityCache(ENTITY_NEGATIVE_TTL)
+
+async def send_to_user(phone, send, shard=None):
+    # send(peer) — сам вызов Telethon; при устаревшем access_hash разрешаем номер заново и повторяем
+    user = await entity_cache.resolve(phone, shard=shard)
+    try:
+        return await send(user.input_peer)
+    except PEER_INVALID_ERRORS as e:
+        print(f"♻️ Пользователь {phone} недоступен по сохраненным данным ({e}), обновляю...", flush=True)
+        user = await entity_cache.resolve(phone, refresh=True, shard=shard)
+        return await send(user.input_peer)
+
+# --- ПОВТОРНОЕ ИСПОЛЬЗОВАНИЕ ЗАГРУЖЕННЫХ ФАЙЛОВ ---
+FILE_REFERENCE_ERRORS = (errors.FileReferenceExpiredError, errors.FileReferenceEmptyError, errors.FileReferenceInvalidError)
+
+class MediaCache:
+    """Файл по URL загружается в Telegram один раз, дальше отправляем ссылку на готовый документ"""
+
+    def __init__(self, revalidate):
+        self.revalidate = revalidate
+        self.urls = {}
+        self.refs = {}
+        self.inflight = {}
+        self.http = None
+        self.hits = 0
+        self.not_modified = 0
+        self.downloads = 0
+        self.uploads = 0
+        self.refreshed = 0
+
+    async def load(self):
+        async with database.read() as db:
+            async with db.execute("SELECT * FROM media_urls") as c:
+                self.urls = {r['url']: dict(r) for r in await c.fetchall()}
+            async with db.execute("SELECT * FROM media_refs") as c:
+                self.refs = {r['sha256']: dict(r) for r in await c.fetchall()}
+        print(f"✅ Кэш загруженных файлов: {len(self.refs)} документов, {len(self.urls)} URL", flush=True)
+
+    def start(self):
+        if self.http is None:
+            self.http = httpx.AsyncClient(timeout=MEDIA_DOWNLOAD_TIMEOUT, follow_redirects=True)
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.aclose()
+            self.http = None
+
+    @staticmethod
+    def _input_media(ref):
+        if ref['kind'] == 'photo':
+            return types.InputPhoto(ref['media_id'], ref['access_hash'], ref['file_reference'])
+        return types.InputDocument(ref['media_id'], ref['access_hash'], ref['file_reference'])
+
+    def _is_fresh(self, entry):
+        try:
+            checked_at = datetime.fromisoformat(str(entry['checked_at']))
+        except ValueError:
+            return False
+        return (datetime.now() - checked_at).total_seconds() < self.revalidate
+
+    async def _save_url(self, url, etag, last_modified, sha):
+        entry = {"url": url, "etag": etag, "last_modified": last_modified, "sha256": sha, "checked_at": datetime.now()}
+        async with database.write() as db:
+            await db.execute("""
+                INSERT OR REPLACE INTO media_urls (url, etag, last_modified, sha256, checked_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (url, etag, last_modified, sha, entry['checked_at']))
+        self.urls[url] = entry
+
+    async def _save_ref(self, key, media, file_name):
+        # key — sha256 содержимого (с префиксом шарда: загруженный документ доступен только своему аккаунту)
+        obj = getattr(media, 'photo', None) or getattr(media, 'document', None)
+        if obj is None or key in self.refs:
+            return
+        ref = {
+            "sha256": key,
+            "kind": 'photo' if isinstance(obj, types.Photo) else 'document',
+            "media_id": obj.id,
+            "access_hash": obj.access_hash,
+            "file_reference": obj.file_reference,
+            "file_name": file_name,
+            "uploaded_at": datetime.now(),
+        }
+        async with database.write() as db:
+            await db.execute("""
+                INSERT OR REPLACE INTO media_refs (sha256, kind, media_id, access_hash, file_reference, file_name, uploaded_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, tuple(ref.values()))
+        self.refs[key] = ref
+
+    async def _forget_ref(self, key):
+        self.refs.pop(key, None)
+        async with database.write() as db:
+            await db.execute("DELETE FROM media_refs WHERE sha256 = ?", (key,))
+
+    async def _download(self, url, headers):
+        # Качаем во временный файл, по пути считая sha256 — в памяти файл целиком не держим
+        self.start()
+        async with self.http.stream("GET", url, headers=headers) as resp:
+            if resp.status_code == 304:
+                return resp, None, None
+            resp.raise_for_status()
+            self.downloads += 1
+            digest = hashlib.sha256()
+            fd, path = tempfile.mkstemp(prefix="tg1c_")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    async for chunk in resp.aiter_bytes():
+                        digest.update(chunk)
+                        f.write(chunk)
+            except BaseException:
+                os.remove(path)
+                raise
+            return resp, path, digest.hexdigest()
+
+    async def _prepare(self, tg, url, force, shard):
+        entry = self.urls.get(url)
+        headers = {}
+        if entry and not force and shard.key(entry['sha256']) in self.refs:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        resp, path, sha = await self._download(url, headers)
+        if path is None:
+            # 304: файл не менялся — отправляем уже загруженный документ
+            self.not_modified += 1
+            await self._save_url(url, entry['etag'], entry['last_modified'], entry['sha256'])
+            key = shard.key(entry['sha256'])
+            return {"key": key, "input": self._input_media(self.refs[key]), "uploaded": False}
+
+        key = shard.key(sha)
+        try:
+            await self._save_url(url, resp.headers.get('ETag'), resp.headers.get('Last-Modified'), sha)
+            if key in self.refs and not force:
+                self.hits += 1
+                return {"key": key, "input": self._input_media(self.refs[key]), "uploaded": False}
+            file_name = os.path.basename(httpx.URL(url).path) or "file"
+            uploaded = await tg.upload_file(path, file_name=file_name)
+            self.uploads += 1
+            return {"key": key, "input": uploaded, "uploaded": True, "file_name": file_name}
+        finally:
+            os.remove(path)
+
+    async def prepare(self, tg, url, force=False, shard=None):
+        shard = shard or shard_router.default
+        entry = self.urls.get(url)
+        ref_key = shard.key(entry['sha256']) if entry else None
+        if not force and ref_key in self.refs and self._is_fresh(entry):
+            self.hits += 1
+            return {"key": ref_key, "input": self._input_media(self.refs[ref_key]), "uploaded": False}
+        # Первая рассылка файла на много получателей: качаем и загружаем один раз, остальные ждут
+        key = (url, force, shard.group_id)
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._prepare(tg, url, force, shard))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def send(self, tg, peer, url, caption, shard=None):
+        # tg_rpc — только сама отправка; скачивание по URL и загрузка в Telegram — этап media_prepare
+        if not str(url).startswith(("http://", "https://")):
+            return await metrics.timed('tg_rpc', tg.send_file(peer, url, caption=caption))
+        prepared = await metrics.timed('media_prepare', self.prepare(tg, url, shard=shard))
+        try:
+            sent = await metrics.timed('tg_rpc', tg.send_file(peer, prepared['input'], caption=caption))
+        except FILE_REFERENCE_ERRORS as e:
+            print(f"♻️ Ссылка на загруженный файл устарела ({e}), загружаю заново", flush=True)
+            self.refreshed += 1
+            await self._forget_ref(prepared['key'])
+            prepared = await metrics.timed('media_prepare', self.prepare(tg, url, force=True, shard=shard))
+            sent = await metrics.timed('tg_rpc', tg.send_file(peer, prepared['input'], caption=caption))
+        if prepared['uploaded']:
+            await self._save_ref(prepared['key'], sent.media, prepared['file_name'])
+        return sent
+
+    def stats(self):
+        return {
+            "documents": len(self.refs),
+            "urls": len(self.urls),
+            "hits": self.hits,
+            "not_modified": self.not_modified,
+            "downloads": self.downloads,
+            "uploads": self.uploads,
+            "refreshed": self.refreshed,
+        }
+
+media_cache = MediaCache(MEDIA_REVALIDATE)
+
+def extract_topic_id(result):
+    # ID темы = ID сервисного сообщения MessageActionTopicCreate из ответа CreateForumTopicRequest
+    updates = getattr(result, 'updates', None) or []
+    for update in updates:
+        if isinstance(update, (types.UpdateNewChannelMessage, types.UpdateNewMessage)):
+            if isinstance(getattr(update.message, 'action', None), types.MessageActionTopicCreate):
+                return update.message.id
+    for update in updates:
+        if isinstance(update, types.UpdateMessageID):
+            return update.id
+    return None
+
+# Создание темы в процессе для каждого client_id: параллельные /send ждут одну и ту же задачу
+topic_creation_inflight = {}
+
+async def create_new_topic(client_id, client_name, messenger='tg', shard=None):
+    # shard — где создавать (пересоздание темы остается в своем форуме); иначе выбирает shard_router
+    key = str(client_id)
+    task = topic_creation_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_create_topic_once(client_id, client_name, messenger, shard))
+        topic_creation_inflight[key] = task
+        task.add_done_callback(lambda _: topic_creation_inflight.pop(key, None))
+    # shield: если HTTP-запрос отменят, остальные ожидающие все равно получат тему
+    return await asyncio.shield(task)
+
+# Ошибки, после которых неизвестно, создана ли тема: запрос мог дойти до Telegram
+TOPIC_UNKNOWN_OUTCOME_ERRORS = (asyncio.TimeoutError, OSError, errors.ServerError, errors.TimedOutError)
+
+async def _create_topic_once(client_id, client_name, messenger='tg', shard=None):
+    # Тему мог только что создать предыдущий запрос — тогда повторно не создаем
+    existing = await topic_cache.get_by_client(client_id)
+    if existing and existing.get('topic_id'):
+        return dict(existing, success=True)
+    with metrics.timer('topic_create'):
+        return await _create_topic(client_id, client_name, messenger, shard or shard_router.for_new_client(client_id))
+
+async def _create_topic(client_id, client_name, messenger='tg', shard=None):
+    shard = shard or shard_router.default
+    group_id = shard.group_id
     try:
-        tg = await get_client()
+        tg = await get_client(shard)
         
         # Красивый заголовок с учетом твоей просьбы не дублировать номер
         if str(client_id) == str(client_name) or "Клиент" in str(client_name):
@@ -134,26 +1762,22 @@ async def create_new_topic(client_id, client_name, messenger='tg'):
             topic_title = f"{client_name} {client_id}"
             
         new_topic_id = None
-        print(f"🛠 Создание темы: {topic_title} в группе {GROUP_ID}...")
+        print(f"🛠 Создание темы: {topic_title} в группе {group_id}...")
 
         try:
-            # Пытаемся создать тему через API
-            result = await tg(functions.messages.CreateForumTopicRequest(
-                peer=GROUP_ID,
+            # Пытаемся создать тему через API — с лимитами аккаунта и паузой после FloodWait, как отправки
+            result = await send_scheduler.call(group_id, lambda: tg(functions.messages.CreateForumTopicRequest(
+                peer=group_id,
                 title=topic_title
-            ))
-            # Достаем ID темы из любого типа ответа
-            for update in result.updates:
-                if hasattr(update, 'id'): 
-                    new_topic_id = update.id
-                    break
-        except Exception as e:
+            )), account=group_id)
+            new_topic_id = extract_topic_id(result)
+            if not new_topic_id:
+                print(f"⚠️ В ответе CreateForumTopicRequest нет ID темы: {type(result).__name__}")
+        except TOPIC_UNKNOWN_OUTCOME_ERRORS as e:
             print(f"⚠️ Ошибка API при создании: {e}")
-
-        # Страховка через историю (если API не вернуло ID сразу)
-        if not new_topic_id:
-            await asyncio.sleep(2)
-            async for msg in tg.iter_messages(GROUP_ID, limit=15):
+            # Исход неизвестен (таймаут, обрыв) — тема могла создаться, ищем ее в истории.
+            # Остальные ошибки (права, заголовок, FloodWait) означают, что темы точно нет: история не нужна
+            async for msg in tg.iter_messages(group_id, limit=15):
                 if hasattr(msg, 'action') and isinstance(msg.action, types.MessageActionTopicCreate):
                     if str(client_id) in msg.action.title:
                         new_topic_id = msg.id
@@ -161,7 +1785,7 @@ async def create_new_topic(client_id, client_name, messenger='tg'):
 
         if new_topic_id:
             # ЗАПИСЬ В БАЗУ: приводим в соответствие со всеми 7 колонками
-            async with aiosqlite.connect(DB_PATH, timeout=10) as db:
+            async with database.write() as db:
                 await db.execute("""
                     INSERT OR REPLACE INTO client_topics 
                     (client_id, topic_id, client_name, phone, manager_ref, messenger, group_id)
@@ -173,11 +1797,21 @@ async def create_new_topic(client_id, client_name, messenger='tg'):
                     str(client_id),    # phone (обычно это тот же номер, что и id)
                     None,              # manager_ref (ставим None, если сейчас нет данных)
                     str(messenger),    # messenger
-                    str(GROUP_ID)      # group_id
+                    str(group_id)      # group_id
                 ))
-                await db.commit()
+            topic_cache.put({
+                "client_id": str(client_id),
+                "topic_id": new_topic_id,
+                "client_name": str(client_name),
+                "phone": str(client_id),
+                "manager_ref": None,
+                "messenger": str(messenger),
+                "group_id": str(group_id)
+            })
             
-            print(f"✅ Тема {new_topic_id} создана (Группа: {GROUP_ID}, Клиент: {client_name})")
+            topic_liveness.mark_alive(group_id, new_topic_id)
+            metrics.inc('topic_creations')
+            print(f"✅ Тема {new_topic_id} создана (Группа: {group_id}, Клиент: {client_name})")
             return {
                 "success": True,
                 "topic_id": new_topic_id,
@@ -185,89 +1819,58 @@ async def create_new_topic(client_id, client_name, messenger='tg'):
                 "client_name": client_name,
                 "phone": client_id,
                 "messenger": messenger,
-                "group_id": GROUP_ID
+                "group_id": str(group_id)
             }
             
+    except TelegramNotReady:
+        # Аккаунт шарда не подключен — вызывающий ответит 503, а не "не удалось создать диалог"
+        raise
+    except errors.FloodWaitError as e:
+        # Тема точно не создана; вызывающий ответит 429 с retry_after
+        print(f"⏳ FloodWait {e.seconds} сек при создании темы для {client_id}", flush=True)
+        raise
     except Exception as e:
         print(f"❌ Критическая ошибка в create_new_topic: {e}")
         return None
 
-async def handler_chat_action(event):
-    try:
-        deleted_topic_id = None
-        
-        # Способ №1: Если это прямое сервисное сообщение об удалении темы
-        if event.action_message and hasattr(event.action_message, 'action'):
-            if isinstance(event.action_message.action, types.MessageActionTopicDelete):
-                # ID темы в данном случае лежит в reply_to
-                if event.action_message.reply_to:
-                    deleted_topic_id = event.action_message.reply_to.reply_to_msg_id
-                print(f"🔍 Нашел ID темы через MessageActionTopicDelete: {deleted_topic_id}")
-
-        # Способ №2: Если пришло событие удаления сообщения (тема — это по сути сообщение №1)
-        if not deleted_topic_id and event.action_deleted:
-            deleted_topic_id = getattr(event.action_message, 'id', None)
-            print(f"🔍 Нашел ID темы через action_deleted: {deleted_topic_id}")
-
-        # Если нашли ID — чистим базу
-        if deleted_topic_id:
-            async with aiosqlite.connect(DB_PATH, timeout=10) as db:
-                cursor = await db.execute("DELETE FROM client_topics WHERE topic_id = ?", (deleted_topic_id,))
-                await db.commit()
-                if cursor.rowcount > 0:
-                    print(f"🗑️ [БАЗА] Запись для темы {deleted_topic_id} удалена")
-                else:
-                    print(f"ℹ️ Событие удаления темы {deleted_topic_id} получено, но в базе такой записи нет")
-                    
-    except Exception as e:
-        print(f"⚠️ Ошибка в handler_chat_action: {e}")
-
 async def raw_handler(update):
-   
-    print(f"DEBUG: Входящее RAW событие типа: {type(update).__name__}", flush=True)
-
-    # 1. Обработка удаления обычных сообщений
-
-    target_ids = []
-    if hasattr(update, 'messages'):
-        target_ids = update.messages
-    elif hasattr(update, 'id'): # Иногда приходит одиночный ID
-        target_ids = [update.id]
-
-    if target_ids:
-        print(f"🗑️ [RAW] Замечено удаление ID: {target_ids}", flush=True)
-        async with aiosqlite.connect(DB_PATH, timeout=10) as db:
-            for msg_id in target_ids:
-                cursor = await db.execute("DELETE FROM client_topics WHERE topic_id = ?", (msg_id,))
-                if cursor.rowcount > 0:
-                    print(f"✅ [БАЗА] Тема {msg_id} удалена из БД", flush=True)
-            await db.commit()
+    # Удаление темы = удаление ее стартового сообщения в одной из наших групп; прочие апдейты отсекает фильтр events.Raw
+    shard = shard_router.by_channel.get(getattr(update, 'channel_id', None))
+    if not isinstance(update, types.UpdateDeleteChannelMessages) or shard is None:
+        return
+    topic_ids = [msg_id for msg_id in update.messages if topic_cache.may_have_topic(shard.group_id, msg_id)]
+    if topic_ids:
+        print(f"🗑️ [RAW] Удалены сообщения-темы: {topic_ids}", flush=True)
+        topic_deletions.add(shard.group_id, topic_ids)
 
 async def get_topic_info_with_retry(phone_number):
+    # Без RPC: живость темы отслеживает topic_liveness, а удаленную тему send_to_topic пересоздаст сам
     clean_phone = str(''.join(filter(str.isdigit, str(phone_number))))
-    async with aiosqlite.connect(DB_PATH, timeout=10) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM client_topics WHERE client_id = ?", (clean_phone,)) as cursor:
-            row = await cursor.fetchone()
-            if not row:
-                return None  # Клиента вообще нет в базе
-
-            client_data = dict(row)
-            try:
-                tg = await get_client()
-                res = await tg.get_messages(GROUP_ID, ids=int(client_data['topic_id']))
-                # Если тема в ТГ "битая" или пустая
-                if not res or isinstance(res, types.MessageEmpty):
-                    client_data['topic_id'] = None # Сигнал к пересозданию
-                return client_data
-            except Exception:
-                # Если ТГ недоступен, возвращаем что есть в базе
-                return client_data
+    with metrics.timer('topic_lookup'):
+        return await topic_cache.get_by_client(clean_phone)
+
+async def send_to_topic(topic_info, text, c_name, messenger='tg'):
+    """Пишет в тему клиента (в форум его шарда); если темы уже нет — пересоздает ее и повторяет отправку один раз"""
+    shard = shard_router.for_group(topic_info.get('group_id'))
+    tg = await get_client(shard)
+    try:
+        with metrics.timer('tg_rpc'):
+            sent = await tg.send_message(shard.group_id, text, reply_to=topic_info['topic_id'])
+    except TOPIC_GONE_ERRORS as e:
+        print(f"♻️ Тема {topic_info['topic_id']} недоступна ({e}), создаю заново...", flush=True)
+        await forget_topic(shard.group_id, topic_info['topic_id'])
+        new_info = await create_new_topic(topic_info['client_id'], c_name, messenger=messenger, shard=shard)
+        if not new_info:
+            raise
+        topic_info.update(new_info)
+        with metrics.timer('tg_rpc'):
+            sent = await tg.send_message(shard.group_id, text, reply_to=topic_info['topic_id'])
+    topic_liveness.mark_alive(shard.group_id, topic_info['topic_id'])
+    return sent
 
 async def find_last_outbound_manager(c_id):
     try:
-        async with aiosqlite.connect(DB_PATH, timeout=10) as db:
-            db.row_factory = aiosqlite.Row
+        async with database.read() as db:
             async with db.execute("""
                 SELECT manager FROM outbound_logs 
                 WHERE client_id = ? AND direction = 'out' AND manager != '' 
@@ -277,38 +1880,418 @@ async def find_last_outbound_manager(c_id):
                 return row['manager'] if row else ""
     except: return ""
 
+# --- ФАЙЛЫ ИЗ TELEGRAM ПО ЗАПРОСУ ---
+class MediaStore:
+    """Хранилище вложений по хэшу содержимого: шардированные каталоги, потолок объема, вытеснение по LRU/возрасту"""
+
+    def __init__(self, root, max_bytes, max_age_days, interval):
+        # owner — процесс, который качает и вытесняет файлы; API-процессы только читают и отмечают обращения
+        self.owner = True
+        self.root = root
+        self.tmp_dir = os.path.join(root, '.tmp')
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.interval = interval
+        self.blobs = {}
+        self.total = 0
+        self.touched = {}
+        self.evicted = 0
+        self.task = None
+        self._wakeup = None
+        self._lock = None
+
+    async def load(self, owner=True):
+        self.owner = owner
+        self._lock = asyncio.Lock()
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        # Недокачанные .part от прошлого запуска не нужны (но не чужие — их может качать воркер прямо сейчас)
+        for name in os.listdir(self.tmp_dir) if owner else []:
+            os.remove(os.path.join(self.tmp_dir, name))
+        async with database.read() as db:
+            async with db.execute("SELECT sha256, path, size FROM media_blobs") as c:
+                self.blobs = {r['sha256']: (r['path'], r['size']) for r in await c.fetchall()}
+        self.total = sum(size or 0 for _, size in self.blobs.values())
+        print(f"✅ Хранилище файлов: {len(self.blobs)} файлов, {self.total // (1024 * 1024)} МБ", flush=True)
+
+    def part_path(self, filename):
+        return os.path.join(self.tmp_dir, f"{filename}.part")
+
+    def path(self, sha):
+        blob = self.blobs.get(sha) if sha else None
+        return blob[0] if blob else None
+
+    async def locate(self, sha):
+        # Файл мог добавить другой процесс после нашего load()
+        path = self.path(sha)
+        if path or not sha:
+            return path
+        async with database.read() as db:
+            async with db.execute("SELECT path, size FROM media_blobs WHERE sha256 = ?", (sha,)) as c:
+                row = await c.fetchone()
+        if not row:
+            return None
+        self.blobs[sha] = (row['path'], row['size'])
+        return row['path']
+
+    def target_path(self, sha, ext):
+        # Тот же файл уже лежит в хранилище — используем его; иначе ab/cd/<sha><ext>
+        return self.path(sha) or os.path.join(self.root, sha[:2], sha[2:4], f"{sha}{ext}")
+
+    async def add(self, part_path, sha, path, size):
+        if sha in self.blobs:
+            os.remove(part_path)  # Дубликат: второй раз не храним
+            self.touch(sha)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(part_path, path)
+        now = datetime.now()
+        async with database.write() as db:
+            await db.execute("""
+                INSERT OR REPLACE INTO media_blobs (sha256, path, size, created_at, last_access)
+                VALUES (?, ?, ?, ?, ?)
+            """, (sha, path, size, now, now))
+        self.blobs[sha] = (path, size)
+        self.total += size
+        if self.total > self.max_bytes and self._wakeup:
+            self._wakeup.set()
+
+    def touch(self, sha):
+        # last_access пишем в БД пачкой при уборке, а не на каждый GET
+        self.touched[sha] = datetime.now()
+
+    async def _flush_touched(self):
+        if not self.touched:
+            return
+        touched, self.touched = self.touched, {}
+        async with database.write() as db:
+            await db.executemany(
+                "UPDATE media_blobs SET last_access = ? WHERE sha256 = ?",
+                [(ts, sha) for sha, ts in touched.items()]
+            )
+
+    async def _evict(self, rows):
+        for row in rows:
+            try:
+                os.remove(row['path'])
+            except FileNotFoundError:
+                pass
+            blob = self.blobs.pop(row['sha256'], None)
+            if blob:
+                self.total -= blob[1] or 0
+            self.touched.pop(row['sha256'], None)
+        async with database.write() as db:
+            await db.executemany("DELETE FROM media_blobs WHERE sha256 = ?", [(r['sha256'],) for r in rows])
+        self.evicted += len(rows)
+
+    async def sweep(self):
+        async with self._lock:
+            await self._sweep()
+
+    async def _sweep(self):
+        await self._flush_touched()
+        evicted_before = self.evicted
+        if self.max_age_days:
+            cutoff = datetime.now() - timedelta(days=self.max_age_days)
+            while True:
+                async with database.read() as db:
+                    async with db.execute(
+                        "SELECT sha256, path, size FROM media_blobs WHERE last_access < ? ORDER BY last_access LIMIT 500", (cutoff,)
+                    ) as c:
+                        rows = await c.fetchall()
+                if not rows:
+                    break
+                await self._evict(rows)
+        while self.total > self.max_bytes and self.blobs:
+            # Самые давно не запрашиваемые — первыми (по индексу last_access)
+            async with database.read() as db:
+                async with db.execute("SELECT sha256, path, size FROM media_blobs ORDER BY last_access LIMIT 100") as c:
+                    rows = await c.fetchall()
+            if not rows:
+                break
+            excess, victims = self.total - self.max_bytes, []
+            for row in rows:
+                if excess <= 0:
+                    break
+                victims.append(row)
+                excess -= row['size'] or 0
+            await self._evict(victims)
+        if self.evicted > evicted_before:
+            print(f"🧹 Удалено из хранилища файлов: {self.evicted - evicted_before}, занято {self.total // (1024 * 1024)} МБ", flush=True)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                if self.owner:
+                    await self.sweep()
+                else:
+                    await self._flush_touched()
+            except Exception as e:
+                print(f"⚠️ Ошибка уборки хранилища файлов: {e}", flush=True)
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self._flush_touched()
+
+    def stats(self):
+        return {
+            "files": len(self.blobs),
+            "bytes": self.total,
+            "max_bytes": self.max_bytes,
+            "evicted": self.evicted,
+        }
+
+media_store = MediaStore(os.path.join(FILES_DIR, 'store'), MEDIA_STORE_MAX_BYTES, MEDIA_MAX_AGE_DAYS, MEDIA_SWEEP_INTERVAL)
+
+class PendingDownload:
+    def __init__(self, part_path):
+        self.part_path = part_path
+        self.final_path = None
+        self.written = 0
+        self.done = False
+        self.error = None
+        self._event = asyncio.Event()
+        # Файл создаем сразу, чтобы читатели могли открыть его до первого куска
+        open(part_path, 'wb').close()
+
+    def changed(self):
+        return self._event
+
+    def notify(self):
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+class LazyMedia:
+    """Вложения менеджеров качаются из Telegram при первом /get_file, одновременно отдаются и кэшируются на диск"""
+
+    def __init__(self):
+        self.downloads = {}
+        self.fetched = 0
+
+    async def remember(self, event):
+        return (await self.remember_many([event]))[0]
+
+    async def remember_many(self, events_list):
+        # Все части альбома — одной транзакцией
+        rows = []
+        for event in events_list:
+            media = event.message.media
+            file_ext, mime_type, size = ".jpg", "image/jpeg", None
+            if hasattr(media, 'document'):
+                mime_type, size = media.document.mime_type, media.document.size
+                for attr in media.document.attributes:
+                    if hasattr(attr, 'file_name'): file_ext = os.path.splitext(attr.file_name)[1]
+            rows.append((f"{uuid.uuid4()}{file_ext}", event.chat_id, event.message.id, mime_type, size, datetime.now()))
+        async with database.write() as db:
+            await db.executemany("""
+                INSERT INTO tg_media (filename, chat_id, message_id, mime_type, size, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, rows)
+        return [row[0] for row in rows]
+
+    async def lookup(self, filename):
+        async with database.read() as db:
+            async with db.execute("SELECT * FROM tg_media WHERE filename = ?", (filename,)) as c:
+                row = await c.fetchone()
+        return dict(row) if row else None
+
+    def start(self, ref):
+        # Одновременные первые запросы одного файла используют одну закачку
+        filename = ref['filename']
+        dl = self.downloads.get(filename)
+        if dl is None:
+            dl = PendingDownload(media_store.part_path(filename))
+            self.downloads[filename] = dl
+            asyncio.ensure_future(self._download(ref, dl))
+        return dl
+
+    async def _download(self, ref, dl):
+        filename = ref['filename']
+        try:
+            tg = await get_client(shard_router.for_group(ref['chat_id']))
+            msg = await tg.get_messages(ref['chat_id'], ids=ref['message_id'])
+            if not msg or not msg.media:
+                raise FileNotFoundError(f"Сообщение {ref['message_id']} с файлом больше не существует")
+            digest = hashlib.sha256()
+            with open(dl.part_path, 'wb') as f:
+                async for chunk in tg.iter_download(msg.media):
+                    f.write(chunk)
+                    f.flush()
+                    digest.update(chunk)
+                    dl.written += len(chunk)
+                    dl.notify()
+            sha = digest.hexdigest()
+            # final_path ставим до переноса: читатели, не успевшие открыть .part, откроют уже его
+            dl.final_path = media_store.target_path(sha, os.path.splitext(filename)[1])
+            await media_store.add(dl.part_path, sha, dl.final_path, dl.written)
+            async with database.write() as db:
+                await db.execute("UPDATE tg_media SET sha256 = ? WHERE filename = ?", (sha, filename))
+            self.fetched += 1
+            print(f"📥 Файл {filename} скачан из Telegram ({dl.written} байт)", flush=True)
+        except Exception as e:
+            dl.error = e
+            print(f"❌ Не удалось скачать {filename}: {e}", flush=True)
+            if os.path.exists(dl.part_path):
+                os.remove(dl.part_path)
+        finally:
+            dl.done = True
+            self.downloads.pop(filename, None)
+            dl.notify()
+
+    async def wait_started(self, dl):
+        # Ждем первый кусок (или ошибку), чтобы успеть ответить 404 до отправки заголовков
+        while not dl.written and not dl.done:
+            await dl.changed().wait()
+
+    async def stream(self, dl, begin=0, end=None, chunk_size=FILE_BUFFER_SIZE):
+        # Читаем уже записанную часть файла, пока закачка идет — ждем следующих кусков.
+        # begin/end — байтовый диапазон для докачки (Range), end не включается
+        try:
+            f = open(dl.part_path, 'rb')
+        except FileNotFoundError:
+            f = open(dl.final_path or dl.part_path, 'rb')  # Закачка успела завершиться и файл переименован
+        with f:
+            pos = begin
+            f.seek(pos)
+            while end is None or pos < end:
+                event = dl.changed()
+                if pos < dl.written:
+                    limit = dl.written if end is None else min(dl.written, end)
+                    data = f.read(min(chunk_size, limit - pos))
+                    pos += len(data)
+                    yield data
+                elif dl.done:
+                    if dl.error:
+                        raise dl.error
+                    return
+                else:
+                    await event.wait()
+
+lazy_media = LazyMedia()
+
 async def save_tg_media(event):
+    # Сам файл не качаем: запоминаем, где он лежит в Telegram, и сразу отдаем ссылку
     if event.message.media:
-        file_ext = ".jpg"
-        if hasattr(event.message.media, 'document'):
-            for attr in event.message.media.document.attributes:
-                if hasattr(attr, 'file_name'): file_ext = os.path.splitext(attr.file_name)[1]
-        filename = f"{uuid.uuid4()}{file_ext}"
-        path = os.path.join(FILES_DIR, filename)
-        await event.message.download_media(file=path)
+        filename = await lazy_media.remember(event)
         return f"{BASE_URL}/get_file/{filename}"
     return None
 
+async def save_tg_album(batch):
+    filenames = await lazy_media.remember_many(batch)
+    return [f"{BASE_URL}/get_file/{filename}" for filename in filenames]
 
-async def start_listener():
+# --- АЛЬБОМЫ МЕНЕДЖЕРОВ ---
+class AlbumBuffer:
+    """Части альбома (общий grouped_id) приходят отдельными событиями: копим их окном и отдаем клиенту одним send_file"""
 
-    tg = await get_client()
+    def __init__(self, window_ms=500):
+        self.window = window_ms / 1000
+        self.pending = {}
+        self.tasks = {}
+        self.albums = 0
+        self.parts = 0
 
-    print("⏳ [LISTENER] Подключение и настройка...", flush=True)
+    def add(self, key, event, relay):
+        # relay(batch) запоминается по первой части — остальные части того же альбома от того же менеджера
+        self.pending.setdefault(key, []).append(event)
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.ensure_future(self._flush_later(key, relay))
+
+    async def _flush_later(self, key, relay):
+        await asyncio.sleep(self.window)
+        self.tasks.pop(key, None)
+        # Части могут прийти не по порядку — в альбоме клиента порядок как у менеджера
+        batch = sorted(self.pending.pop(key, []), key=lambda e: e.message.id)
+        self.albums += 1
+        self.parts += len(batch)
+        try:
+            await relay(batch)
+        except Exception as e:
+            print(f"❌ Ошибка отправки альбома: {e}", flush=True)
+
+    async def stop(self):
+        # Недособранные альбомы досылаем, а не теряем
+        if self.tasks:
+            await asyncio.gather(*list(self.tasks.values()), return_exceptions=True)
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "albums": self.albums,
+            "parts": self.parts,
+        }
+
+album_buffer = AlbumBuffer(ALBUM_WINDOW_MS)
+
+async def relay_to_client(tg, shard, batch, s_phone):
+    """Ответ менеджера из темы клиенту; batch — одно сообщение или все части альбома"""
+    first = batch[0]
+    row = await topic_cache.get_by_topic(shard.group_id, first.reply_to_msg_id)
+    if not row:
+        return
+    try:
+        # Используем client_id, если он есть, иначе телефон
+        target_key = row['client_id'] if row['client_id'] else row['phone']
+        target_ent = await entity_cache.resolve(target_key, shard=shard)
+        texts = [(e.raw_text or "").strip() for e in batch]
+
+        # Живые ответы менеджеров идут в приоритетной полосе планировщика; файлы не качаем — шлем ссылки на media
+        if len(batch) > 1:
+            f_urls = await save_tg_album(batch)
+            media = [e.message.media for e in batch]
+            sent = await send_scheduler.run(target_ent.id, lambda: send_to_user(target_key, lambda peer: metrics.timed('tg_rpc', tg.send_file(peer, media, caption=texts)), shard), priority=PRIORITY_LIVE, account=shard.group_id)
+        elif first.message.media:
+            f_urls = [await save_tg_media(first)]
+            sent = [await send_scheduler.run(target_ent.id, lambda: send_to_user(target_key, lambda peer: metrics.timed('tg_rpc', tg.send_file(peer, first.message.media, caption=texts[0])), shard), priority=PRIORITY_LIVE, account=shard.group_id)]
+        else:
+            f_urls = [None]
+            sent = [await send_scheduler.run(target_ent.id, lambda: send_to_user(target_key, lambda peer: metrics.timed('tg_rpc', tg.send_message(peer, texts[0])), shard), priority=PRIORITY_LIVE, account=shard.group_id)]
+
+        m_fio = MANAGERS.get(s_phone, s_phone)
+
+        # Строки альбома встают в очередь логов подряд и пишутся одной транзакцией
+        for event, text, f_url, msg in zip(batch, texts, f_urls, sent):
+            await log_to_db(
+                source="Manager", 
+                phone=row['phone'], 
+                text=text,
+                c_name=row['client_name'], 
+                c_id=str(target_ent.id), 
+                manager_fio=m_fio, 
+                s_number=s_phone, 
+                f_url=f_url, 
+                direction="out", 
+                tg_id=msg.id,
+                messenger='tg',
+                status="ok",
+                topic_id=event.reply_to_msg_id,
+                group_id=shard.group_id
+            )
+        print(f"➡️ [OUT] Из темы {first.reply_to_msg_id} клиенту {row['phone']}" + (f" (альбом: {len(batch)})" if len(batch) > 1 else ""))
+    except Exception as e: 
+        print(f"❌ Ошибка OUT: {e}")
 
-    tg.add_event_handler(raw_handler, events.Raw)
 
-    # 1. ОБРАБОТЧИК СОБЫТИЙ ЧАТА (Удаление тем ловим тут)
-    @tg.on(events.ChatAction)
-    async def action_handler(event):
-        # Ловим сервисное сообщение об удалении темы
-        if event.action_message and isinstance(event.action_message.action, types.MessageActionTopicDelete):
-            t_id = event.action_message.reply_to.reply_to_msg_id
-            print(f"🗑️ Обнаружено удаление диалога {t_id}, чищу базу...", flush=True)
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute("DELETE FROM client_topics WHERE topic_id = ?", (t_id,))
-                await db.commit()
-                print(f"✅ Диалог {t_id} удален")
+def setup_listener(tg, shard):
+
+    print("⏳ [LISTENER] Подключение и настройка...", flush=True)
+
+    # Удаление темы приходит только сырым апдейтом: ChatAction Telethon для него события не строит
+    tg.add_event_handler(raw_handler, events.Raw(types=types.UpdateDeleteChannelMessages))
 
     @tg.on(events.NewMessage())
     async def handler(event):
@@ -316,137 +2299,235 @@ async def start_listener():
 
         sender = await event.get_sender()
         s_id = str(event.sender_id)
-        raw_text = (event.raw_text or "").strip()
 
-        # 1. ГРУППА (МЕНЕДЖЕР -> КЛИЕНТУ)
+        # 1. ГРУППА (МЕНЕДЖЕР -> КЛИЕНТУ); ID тем смотрим только в форуме этого аккаунта
         if event.is_group:
+            if event.chat_id != shard.group_id:
+                return
 
             sender = await event.get_sender()
             s_phone = str(getattr(sender, 'phone', '') or '').lstrip('+').strip()
             
-            # Пересылка из темы клиенту
+            # Пересылка из темы клиенту; части альбома ждем окно ALBUM_WINDOW_MS и шлем одним вызовом
             if event.reply_to_msg_id:
-                async with aiosqlite.connect(DB_PATH) as db:
-                    db.row_factory = aiosqlite.Row
-                    async with db.execute("SELECT * FROM client_topics WHERE topic_id = ?", (event.reply_to_msg_id,)) as c:
-                        row = await c.fetchone()
-                
-                if row:
-                    try:
-                        # Используем client_id, если он есть, иначе телефон
-                        target_key = row['client_id'] if row['client_id'] else row['phone']
-                        target_ent = await tg.get_entity(target_key)
-                        
-                        f_url = await save_tg_media(event)
-                        
-                        if event.message.media: 
-                            sent = await tg.send_file(target_ent, event.message.media, caption=raw_text)
-                        else: 
-                            sent = await tg.send_message(target_ent, raw_text)
-                        
-                        m_fio = MANAGERS.get(s_phone, s_phone)
-                        
-                        # ОБНОВЛЕННЫЙ ЛОГ (все поля на месте)
-                        await log_to_db(
-                            source="Manager", 
-                            phone=row['phone'], 
-                            text=raw_text,
-                            c_name=row['client_name'], 
-                            c_id=str(target_ent.id), 
-                            manager_fio=m_fio, 
-                            s_number=s_phone, 
-                            f_url=f_url, 
-                            direction="out", 
-                            tg_id=sent.id,
-                            messenger='tg',
-                            status="ok",
-                            topic_id=event.reply_to_msg_id,
-                            group_id=GROUP_ID
-                        )
-                        print(f"➡️ [OUT] Из темы {event.reply_to_msg_id} клиенту {row['phone']}")
-                    except Exception as e: 
-                        print(f"❌ Ошибка OUT: {e}")
+                if event.message.grouped_id:
+                    album_buffer.add((shard.group_id, event.message.grouped_id), event, lambda batch: relay_to_client(tg, shard, batch, s_phone))
+                else:
+                    await relay_to_client(tg, shard, [event], s_phone)
             return
 
-            # Пересылка из темы клиенту
-            if event.reply_to_msg_id:
-                async with aiosqlite.connect(DB_PATH) as db:
-                    db.row_factory = aiosqlite.Row
-                    async with db.execute("SELECT * FROM client_topics WHERE topic_id = ?", (event.reply_to_msg_id,)) as c:
-                        row = await c.fetchone()
-                
-                if row:
-                    try:
-                        target_id = int(row['client_id'])
-                        target_ent = await tg.get_entity(target_id) # Обязательно для access_hash
-                        f_url = await save_tg_media(event)
-                        
-                        if event.message.media: sent = await tg.send_file(target_ent, event.message.media, caption=raw_text)
-                        else: sent = await tg.send_message(target_ent, raw_text)
-                        
-                        m_fio = MANAGERS.get(s_phone, s_phone)
-                        await log_to_db(source="Manager", phone=row['phone'], c_name=row['client_name'], text=raw_text, c_id=str(target_id), manager_fio=m_fio, s_number=s_phone, f_url=f_url, direction="out", tg_id=sent.id)
-                        print(f"➡️ [OUT] Из темы в личку клиенту {target_id}")
-                    except Exception as e: print(f"❌ Ошибка OUT: {e}")
-            return
 
-        # 2. ЛИЧКА (КЛИЕНТ -> В ТЕМУ)
-        # 1. ГРУППА (МЕНЕДЖЕР -> КЛИЕНТУ)
-        if event.is_group:
-            # ... (твой код создания темы остается выше) ...
+# --- ОЧЕРЕДЬ ЗАДАНИЙ API -> TELEGRAM-ВОРКЕР ---
+# Заголовок, которым воркер помечает повтор запроса из задания: такой запрос выполняется синхронно
+JOB_HEADER = "X-Job-Id"
 
-            # Пересылка из темы клиенту
-            if event.reply_to_msg_id:
-                async with aiosqlite.connect(DB_PATH) as db:
-                    db.row_factory = aiosqlite.Row
-                    async with db.execute("SELECT * FROM client_topics WHERE topic_id = ?", (event.reply_to_msg_id,)) as c:
-                        row = await c.fetchone()
-                
-                if row:
-                    try:
-                        # Используем client_id, если он есть, иначе телефон
-                        target_key = row['client_id'] if row['client_id'] else row['phone']
-                        target_ent = await tg.get_entity(target_key)
-                        
-                        f_url = await save_tg_media(event)
-                        
-                        if event.message.media: 
-                            sent = await tg.send_file(target_ent, event.message.media, caption=raw_text)
-                        else: 
-                            sent = await tg.send_message(target_ent, raw_text)
-                        
-                        m_fio = MANAGERS.get(s_phone, s_phone)
-                        
-                        # ОБНОВЛЕННЫЙ ЛОГ (все поля на месте)
-                        await log_to_db(
-                            source="Manager", 
-                            phone=row['phone'], 
-                            text=raw_text,
-                            c_name=row['client_name'], 
-                            c_id=str(target_ent.id), 
-                            manager_fio=m_fio, 
-                            s_number=s_phone, 
-                            f_url=f_url, 
-                            direction="out", 
-                            tg_id=sent.id,
-                            messenger='tg',
-                            status="ok",
-                            topic_id=event.reply_to_msg_id,
-                            group_id=GROUP_ID
-                        )
-                        print(f"➡️ [OUT] Из темы {event.reply_to_msg_id} клиенту {row['phone']}")
-                    except Exception as e: 
-                        print(f"❌ Ошибка OUT: {e}")
-            return
+class JobQueue:
+    """Задания API-процессов Telegram-воркеру в таблице jobs: переживают перезапуск любой из сторон"""
 
-    await tg.run_until_disconnected()
-    
+    def __init__(self, poll_ms=50, concurrency=50, keep_hours=24):
+        self.poll_interval = poll_ms / 1000
+        self.concurrency = max(1, concurrency)
+        self.keep_hours = keep_hours
+        self.handlers = {}
+        self.active = set()
+        self.task = None
+        self.done = 0
+        self.failed = 0
+
+    # Сторона API
+    async def submit(self, kind, payload):
+        job_id = uuid.uuid4().hex
+        async with database.write() as db:
+            await db.execute(
+                "INSERT INTO jobs (id, kind, payload, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, kind, json.dumps(payload, ensure_ascii=False), datetime.now())
+            )
+        return job_id
+
+    async def get(self, job_id):
+        async with database.read() as db:
+            async with db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)) as c:
+                row = await c.fetchone()
+        return dict(row) if row else None
+
+    async def wait(self, job_id, timeout):
+        # Другой процесс сигнал не пришлет — опрашиваем строку, увеличивая паузу до 0.5 сек
+        deadline = time.monotonic() + timeout
+        delay = self.poll_interval
+        while True:
+            job = await self.get(job_id)
+            if job is None or job['status'] in ("done", "failed"):
+                return job
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(min(delay, max(0, deadline - time.monotonic())))
+            delay = min(delay * 2, 0.5)
+
+    @staticmethod
+    def info(job):
+        result = job['result']
+        try:
+            result = json.loads(result) if result else None
+        except ValueError:
+            pass
+        return {
+            "job_id": job['id'],
+            "status": job['status'],
+            "http_status": job['http_status'],
+            "result": result,
+            "created_at": job['created_at'],
+            "finished_at": job['finished_at'],
+        }
+
+    # Сторона Telegram-воркера
+    async def start(self, handlers):
+        self.handlers = handlers
+        # Задания, прерванные прошлым запуском, не повторяем: сообщение могло уже уйти клиенту
+        async with database.write() as db:
+            cursor = await db.execute(
+                "UPDATE jobs SET status = 'failed', http_status = 500, result = ?, finished_at = ? WHERE status = 'running'",
+                (json.dumps({"error": "Прервано перезапуском Telegram-воркера"}, ensure_ascii=False), datetime.now())
+            )
+        if cursor.rowcount:
+            print(f"⚠️ Прервано перезапуском заданий: {cursor.rowcount}", flush=True)
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.active:
+            # Даем начатым отправкам закончиться; оборванные при следующем старте станут failed
+            await asyncio.wait(list(self.active), timeout=10)
+
+    async def _claim(self, limit):
+        async with database.write() as db:
+            async with db.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT ?", (limit,)
+            ) as c:
+                rows = [dict(r) for r in await c.fetchall()]
+            if rows:
+                await db.executemany(
+                    "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?",
+                    [(datetime.now(), r['id']) for r in rows]
+                )
+        return rows
+
+    async def _cleanup(self):
+        cutoff = datetime.now() - timedelta(hours=self.keep_hours)
+        async with database.write() as db:
+            await db.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,))
+
+    async def _run(self):
+        last_cleanup = 0
+        while True:
+            try:
+                free = self.concurrency - len(self.active)
+                jobs = await self._claim(free) if free > 0 else []
+                for job in jobs:
+                    task = asyncio.ensure_future(self._execute(job))
+                    self.active.add(task)
+                    task.add_done_callback(self.active.discard)
+                if time.monotonic() - last_cleanup > 3600:
+                    last_cleanup = time.monotonic()
+                    await self._cleanup()
+            except Exception as e:
+                jobs = []
+                print(f"⚠️ Ошибка очереди заданий: {e}", flush=True)
+            if not jobs:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _execute(self, job):
+        handler = self.handlers.get(job['kind'])
+        try:
+            if handler is None:
+                raise ValueError(f"Неизвестный тип задания: {job['kind']}")
+            status, body = await handler(job['id'], json.loads(job['payload']))
+        except Exception as e:
+            status, body = 500, json.dumps({"error": str(e)}, ensure_ascii=False)
+        ok = status < 400
+        if ok:
+            self.done += 1
+        else:
+            self.failed += 1
+        try:
+            async with database.write() as db:
+                await db.execute(
+                    "UPDATE jobs SET status = ?, http_status = ?, result = ?, finished_at = ? WHERE id = ?",
+                    ("done" if ok else "failed", status, body, datetime.now(), job['id'])
+                )
+        except Exception as e:
+            print(f"❌ Не удалось сохранить результат задания {job['id']}: {e}", flush=True)
+
+    def stats(self):
+        return {
+            "role": APP_ROLE,
+            "active": len(self.active),
+            "done": self.done,
+            "failed": self.failed,
+        }
+
+job_queue = JobQueue(JOB_POLL_MS, JOB_CONCURRENCY, JOB_KEEP_HOURS)
+
+async def run_http_job(job_id, payload):
+    # Повторяем исходный HTTP-запрос 1С внутри воркера теми же маршрутами, что и в одиночном режиме
+    client = app.test_client()
+    headers = {JOB_HEADER: job_id}
+    if payload.get('content_type'):
+        headers["Content-Type"] = payload['content_type']
+    # Исходная строка запроса — как есть в адресе: query_string test_client принимает только dict
+    path = payload['path'] + ('?' + payload['query'] if payload.get('query') else '')
+    response = await client.open(
+        path, method=payload['method'], data=payload['body'].encode('utf-8'), headers=headers
+    )
+    return response.status_code, await response.get_data(as_text=True)
+
+async def run_fetch_media_job(job_id, payload):
+    # Скачать вложение в хранилище, чтобы API-процесс отдал его с диска
+    ref = await lazy_media.lookup(payload['filename'])
+    if not ref:
+        return 404, json.dumps({"error": "Файл не найден"}, ensure_ascii=False)
+    path = media_store.path(ref['sha256'])
+    if not (path and os.path.isfile(path)):
+        dl = lazy_media.start(ref)
+        while not dl.done:
+            await dl.changed().wait()
+        if dl.error:
+            return 404, json.dumps({"error": str(dl.error)}, ensure_ascii=False)
+    return 200, json.dumps({"status": "ok"})
+
+JOB_HANDLERS = {
+    "http": run_http_job,
+    "fetch_media": run_fetch_media_job,
+}
+
+def async_requested(data=None):
+    # "async": true (в теле или в адресе) — не ждать Telegram; повтор из задания воркера всегда синхронный
+    if request.headers.get(JOB_HEADER):
+        return False
+    return bool((isinstance(data, dict) and data.get("async")) or request.args.get("async"))
+
+async def relay_to_worker():
+    # APP_ROLE=api: запрос целиком уходит Telegram-воркеру, ответ воркера возвращаем 1С как есть
+    body = await request.get_data(as_text=True)
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+    job_id = await job_queue.submit("http", {
+        "method": request.method,
+        "path": request.path,
+        "query": request.query_string.decode(),
+        "content_type": request.content_type,
+        "body": body,
+    })
+    job = None if async_requested(data) else await job_queue.wait(job_id, JOB_WAIT_TIMEOUT)
+    if job is None:
+        return jsonify({"status": "queued", "job_id": job_id}), 202
+    return Response(job['result'], status=job['http_status'], content_type="application/json")
 
 # --- API ROUTES ---
-@app.route('/send', methods=['POST'])
-async def send_text():
-    data = await request.get_json()
-    
+def parse_send_item(data):
     # Парсим основные данные
     phone = str(data.get("phone", "")).lstrip('+').strip()
     text = data.get("text", "")
@@ -460,6 +2541,16 @@ async def send_text():
     # ---------------------
 
     messenger = str(data.get("messenger", "tg")).lower()
+    return phone, text, mgr_fio, c_name, messenger
+
+def is_whatsapp(messenger):
+    return any(word in messenger for word in ["wa", "whatsapp", "вотсап"])
+
+@app.route('/send', methods=['POST'])
+@requires_telegram
+async def send_text():
+    data = await request.get_json()
+    phone, text, mgr_fio, c_name, messenger = parse_send_item(data)
 
     # Ищем или создаем тему
     topic_info = await get_topic_info_with_retry(phone)
@@ -467,121 +2558,760 @@ async def send_text():
         topic_id = topic_info['topic_id']
     else:
         # Передаем уже проверенное имя c_name
-        topic_info = await create_new_topic(phone, c_name, messenger=messenger)
-        topic_id = topic_info['topic_id']   
+        try:
+            topic_info = await create_new_topic(phone, c_name, messenger=messenger)
+        except TelegramNotReady as e:
+            return telegram_unavailable(e)
+        except errors.FloodWaitError as e:
+            return jsonify({"error": str(e), "retry_after": e.seconds}), 429
+        topic_id = topic_info['topic_id'] if topic_info else None
 
     if not topic_id:
         return jsonify({"error": "Не удалось создать диалог в Telegram"}), 500
+    # Форум и аккаунт клиента: лимиты отправки считаются по своему аккаунту
+    group_id = shard_router.for_group(topic_info.get('group_id')).group_id
+
+    # "async": true — не ждать Telegram, сразу вернуть job_id (статус: GET /jobs/<job_id>)
+    wait = not async_requested(data)
 
     try:
         # 3. РАЗВИЛКА: WhatsApp или Telegram
-        if any(word in messenger for word in ["wa", "whatsapp", "вотсап"]):
+        if is_whatsapp(messenger):
             # --- ОТПРАВКА В WHATSAPP ---
             success, msg_id = await send_whatsapp_message(phone, text)
-            used_messenger = "wa"
             
             if success:
                 # ДУБЛИРУЕМ В TELEGRAM TOPIC (без имени менеджера)
-                tg = await get_client()
                 wa_report = (
                     f"🟢 **WhatsApp**\n\n"
                     f"{text}"
                 )
-                await tg.send_message(GROUP_ID, wa_report, reply_to=topic_id)
-        
-        else:
-            # --- ОТПРАВКА В TELEGRAM ---
-            tg = await get_client()
-            sent = await tg.send_message(GROUP_ID, text, reply_to=topic_id)
-            success, msg_id = True, sent.id
-            used_messenger = "tg"
-
-        # 4. ЛОГИРОВАНИЕ
-        if success:
+                job = send_scheduler.submit(group_id, lambda: send_to_topic(topic_info, wa_report, c_name, messenger=messenger), account=group_id)
+                if wait:
+                    await job.wait()
+                # 4. ЛОГИРОВАНИЕ
+                await log_to_db(
+                    source="1C", 
+                    phone=phone, 
+                    text=text, 
+                    manager_fio=mgr_fio, 
+                    direction="out", 
+                    tg_id=msg_id, 
+                    topic_id=topic_info['topic_id'],
+                    c_name=topic_info['client_name'],
+                    c_id=topic_info['client_id'],
+                    messenger="wa"
+                )
+                return jsonify({"status": "ok", "topic_id": topic_info['topic_id'], "job_id": job.id}), 200
+            else:
+                # Отчет об ошибке в тему тоже сделаем коротким
+                job = send_scheduler.submit(group_id, lambda: send_to_topic(topic_info, f"🔴 **Ошибка WhatsApp!**\n{msg_id}", c_name, messenger=messenger), account=group_id)
+                if wait:
+                    await job.wait()
+                return jsonify({"error": msg_id}), 400
+
+        # --- ОТПРАВКА В TELEGRAM ---
+        async def deliver():
+            sent = await send_to_topic(topic_info, text, c_name, messenger=messenger)
+            # 4. ЛОГИРОВАНИЕ (тема могла пересоздаться при отправке)
             await log_to_db(
                 source="1C", 
                 phone=phone, 
                 text=text, 
                 manager_fio=mgr_fio, 
                 direction="out", 
-                tg_id=msg_id, 
-                topic_id=topic_id,
-                client_name=topic_info['client_name'],
-                client_id=topic_info['client_id'],
-                messenger=used_messenger
+                tg_id=sent.id, 
+                topic_id=topic_info['topic_id'],
+                c_name=topic_info['client_name'],
+                c_id=topic_info['client_id'],
+                messenger="tg"
             )
-            return jsonify({"status": "ok", "topic_id": topic_id}), 200
-        else:
-            # Отчет об ошибке в тему тоже сделаем коротким
-            tg = await get_client()
-            await tg.send_message(GROUP_ID, f"🔴 **Ошибка WhatsApp!**\n{msg_id}", reply_to=topic_id)
-            return jsonify({"error": msg_id}), 400
+            return {"status": "ok", "topic_id": topic_info['topic_id']}
+
+        job = send_scheduler.submit(group_id, deliver, account=group_id)
+        if not wait:
+            return jsonify({"status": "queued", "job_id": job.id, "topic_id": topic_id}), 202
+        return jsonify(await job.wait()), 200
 
+    except TelegramNotReady as e:
+        return telegram_unavailable(e)
+    except errors.FloodWaitError as e:
+        print(f"❌ FloodWait в send_text: {e.seconds} сек")
+        return jsonify({"error": str(e), "retry_after": e.seconds}), 429
     except Exception as e:
         print(f"❌ Ошибка в send_text: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/send_file', methods=['POST'])
+@requires_telegram
 async def send_file():
     data = await request.get_json()
     phone, f_url, text, mgr_fio = str(data.get("phone", "")).lstrip('+').strip(), data.get("file"), data.get("text", ""), str(data.get("manager", ""))
-    tg = await get_client()
     try:
-        ent = await tg.get_entity(phone)
-        async with aiosqlite.connect(DB_PATH) as db:
+        shard = await shard_router.for_client(phone)
+        tg = await get_client(shard)
+        ent = await entity_cache.resolve(phone, shard=shard)
+        async with database.write() as db:
             await db.execute("DELETE FROM client_topics WHERE client_id = ?", (str(ent.id),))
-            await db.commit()
-        sent = await tg.send_file(ent, f_url, caption=text)
-        await log_to_db(source="1C", phone=phone, c_name=f"{ent.first_name or ''}", text=text, c_id=str(ent.id), manager_fio=mgr_fio, f_url=f_url, direction="out", tg_id=sent.id)
-        print(f"🚀 [API] Файл отправлен клиенту {ent.id}")
-        return jsonify({"status": "ok"}), 200
+        topic_cache.drop_client(ent.id)
+
+        async def deliver():
+            sent = await send_to_user(phone, lambda peer: media_cache.send(tg, peer, f_url, text, shard=shard), shard)
+            await log_to_db(source="1C", phone=phone, c_name=f"{ent.first_name or ''}", text=text, c_id=str(ent.id), manager_fio=mgr_fio, f_url=f_url, direction="out", tg_id=sent.id)
+            print(f"🚀 [API] Файл отправлен клиенту {ent.id}")
+            return {"status": "ok"}
+
+        job = send_scheduler.submit(ent.id, deliver, account=shard.group_id)
+        if async_requested(data):
+            return jsonify({"status": "queued", "job_id": job.id}), 202
+        return jsonify(await job.wait()), 200
+    except TelegramNotReady as e: return telegram_unavailable(e)
+    except errors.FloodWaitError as e: return jsonify({"error": str(e), "retry_after": e.seconds}), 429
     except Exception as e: return jsonify({"error": str(e)}), 500
 
+# --- МАССОВАЯ РАССЫЛКА ---
+async def read_batch_items():
+    # Принимаем JSON-массив, {"items": [...], "async": ...} или NDJSON (по строке на получателя)
+    raw = await request.get_data(as_text=True)
+    if "ndjson" in (request.content_type or ""):
+        return [json.loads(line) for line in raw.splitlines() if line.strip()], {}
+    data = json.loads(raw or "[]")
+    if isinstance(data, dict):
+        return data.get("items") or [], data
+    return data, {}
+
+async def resolve_batch_topics(items):
+    # Все темы одним заходом в кэш/БД, недостающие создаем с ограниченной параллельностью
+    keys = {str(''.join(filter(str.isdigit, it['phone']))) for it in items}
+    topics = await topic_cache.get_many_by_client(keys)
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def create(it):
+        async with sem:
+            return await create_new_topic(it['phone'], it['c_name'], messenger=it['messenger'])
+
+    pending = {}
+    for it in items:
+        key = str(''.join(filter(str.isdigit, it['phone'])))
+        if key and key not in topics and key not in pending:
+            pending[key] = it
+    created = await asyncio.gather(*[create(it) for it in pending.values()], return_exceptions=True)
+    for key, info in zip(pending, created):
+        if isinstance(info, dict) and info.get('topic_id'):
+            topics[key] = info
+        elif isinstance(info, errors.FloodWaitError):
+            topics[key] = {"error": str(info), "retry_after": info.seconds}
+        elif isinstance(info, TelegramNotReady):
+            topics[key] = {"error": str(info), "retry_after": max(1, int(TG_READY_TIMEOUT)), "unavailable": True}
+    return topics
+
+async def deliver_batch_item(it, topic_info, sem):
+    result = {"index": it['index'], "phone": it['phone']}
+    if not topic_info or not topic_info.get('topic_id'):
+        if topic_info and topic_info.get('error'):
+            return dict(result, status="error", **{k: v for k, v in topic_info.items() if k in ('error', 'retry_after', 'unavailable')})
+        return dict(result, status="error", error="Не удалось создать диалог в Telegram")
+    info = dict(topic_info)
+    group_id = shard_router.for_group(info.get('group_id')).group_id
+    try:
+        async with sem:
+            if is_whatsapp(it['messenger']):
+                success, msg_id = await send_whatsapp_message(it['phone'], it['text'])
+                if not success:
+                    return dict(result, status="error", error=msg_id)
+                report = f"🟢 **WhatsApp**\n\n{it['text']}"
+                await send_scheduler.run(group_id, lambda: send_to_topic(info, report, it['c_name'], messenger=it['messenger']), priority=PRIORITY_BULK, account=group_id)
+                used_messenger = "wa"
+            else:
+                sent = await send_scheduler.run(group_id, lambda: send_to_topic(info, it['text'], it['c_name'], messenger=it['messenger']), priority=PRIORITY_BULK, account=group_id)
+                msg_id, used_messenger = sent.id, "tg"
+    except TelegramNotReady as e:
+        return dict(result, status="error", error=str(e), retry_after=max(1, int(TG_READY_TIMEOUT)), unavailable=True)
+    except Exception as e:
+        return dict(result, status="error", error=str(e))
+    # Без ожидания записи: строки пакета уходят в БД общими транзакциями log_writer
+    await log_to_db(
+        source="1C",
+        phone=it['phone'],
+        text=it['text'],
+        manager_fio=it['mgr_fio'],
+        direction="out",
+        tg_id=msg_id,
+        topic_id=info['topic_id'],
+        c_name=info['client_name'],
+        c_id=info['client_id'],
+        messenger=used_messenger
+    )
+    return dict(result, status="ok", topic_id=info['topic_id'])
+
+async def run_batch(items, job=None):
+    topics = await resolve_batch_topics(items)
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+    results = [None] * len(items)
+    done = 0
+
+    async def one(it):
+        nonlocal done
+        key = str(''.join(filter(str.isdigit, it['phone'])))
+        results[it['index']] = await deliver_batch_item(it, topics.get(key), sem)
+        done += 1
+        if job is not None:
+            job.result = {"total": len(items), "processed": done}
+
+    await asyncio.gather(*[one(it) for it in items])
+    ok = sum(1 for r in results if r['status'] == "ok")
+    print(f"📦 [BATCH] Отправлено {ok} из {len(items)}", flush=True)
+    return {"total": len(items), "ok": ok, "failed": len(items) - ok, "items": results}
+
+@app.route('/send_batch', methods=['POST'])
+@requires_telegram
+async def send_batch():
+    try:
+        raw_items, options = await read_batch_items()
+    except ValueError as e:
+        return jsonify({"error": f"Некорректный JSON: {e}"}), 400
+    if not isinstance(raw_items, list) or not raw_items:
+        return jsonify({"error": "Ожидается непустой массив получателей"}), 400
+    if len(raw_items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Не больше {BATCH_MAX_ITEMS} получателей за запрос"}), 413
+
+    items = []
+    for i, data in enumerate(raw_items):
+        phone, text, mgr_fio, c_name, messenger = parse_send_item(data if isinstance(data, dict) else {})
+        items.append({"index": i, "phone": phone, "text": text, "mgr_fio": mgr_fio, "c_name": c_name, "messenger": messenger})
+
+    if async_requested(options):
+        job = send_scheduler.spawn(lambda job: run_batch(items, job))
+        return jsonify({"status": "queued", "job_id": job.id, "total": len(items)}), 202
+    result = await run_batch(items)
+    if all(r.get('unavailable') for r in result['items']):
+        # Ни одного получателя: аккаунты их шардов не подключены — весь пакет можно повторить позже
+        return jsonify(dict(result, error="Telegram недоступен", shards=shard_router.state())), 503, {"Retry-After": str(max(1, int(TG_READY_TIMEOUT)))}
+    return jsonify(result), 200
+
+# --- GREEN-API (WHATSAPP) ---
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self.trips = 0
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            # Остыли — пропускаем один пробный запрос
+            self.state = "half_open"
+            return True
+        if self.state == "half_open":
+            return False  # Пробный запрос уже в полете
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.trips += 1
+                print(f"🔌 Green-API недоступен, пауза {self.cooldown:.0f} сек", flush=True)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def abandon(self):
+        # Пробный запрос отменили (1С отключилась, таймаут ответа) — исход неизвестен: снова ждем cooldown,
+        # иначе предохранитель навсегда остался бы в half_open
+        if self.state == "half_open":
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def retry_in(self):
+        if self.state != "open":
+            return 0
+        return max(0, round(self.cooldown - (time.monotonic() - self.opened_at), 1))
+
+class GreenApiClient:
+    """Один AsyncClient на все время жизни приложения: keep-alive, повторы с джиттером, предохранитель"""
+
+    # Повторяем только то, что Green-API точно не обработал: иначе клиент получит сообщение дважды
+    RETRY_STATUSES = {429, 502, 503, 504}
+    RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+    def __init__(self):
+        self.http = None
+        self.breaker = CircuitBreaker(WA_BREAKER_THRESHOLD, WA_BREAKER_COOLDOWN)
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+
+    def start(self):
+        if self.http is None:
+            self.http = httpx.AsyncClient(
+                base_url=WA_API_URL,
+                timeout=WA_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=WA_MAX_CONNECTIONS,
+                    max_keepalive_connections=WA_MAX_KEEPALIVE,
+                ),
+            )
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.aclose()
+            self.http = None
+
+    def _backoff(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), 30)
+        # Экспоненциальная задержка с полным джиттером, чтобы повторы не шли залпом
+        return random.uniform(0, min(8, 0.5 * 2 ** attempt))
+
+    async def post(self, method, payload):
+        if not self.breaker.allow():
+            return None, f"Green-API временно недоступен, повтор через {self.breaker.retry_in()} сек"
+        try:
+            return await self._post(method, payload)
+        except BaseException:
+            # Отмена или непредвиденная ошибка: исход не записан, пробный запрос не должен заклинить предохранитель
+            self.breaker.abandon()
+            raise
+
+    async def _post(self, method, payload):
+        self.start()
+        path = f"/waInstance{WA_ID_INSTANCE}/{method}/{WA_API_TOKEN}"
+        error = None
+        for attempt in range(WA_RETRIES + 1):
+            if attempt:
+                self.retries += 1
+            self.requests += 1
+            self.in_flight += 1
+            response, retryable = None, False
+            try:
+                with metrics.timer('green_api'):
+                    response = await self.http.post(path, json=payload)
+            except httpx.HTTPError as e:
+                error = f"{type(e).__name__}: {e}"
+                retryable = isinstance(e, self.RETRY_ERRORS)
+            finally:
+                self.in_flight -= 1
+            if response is not None:
+                if response.status_code < 500 and response.status_code != 429:
+                    # Ответ получен (даже 4xx) — сервис жив
+                    self.breaker.record_success()
+                    return response, None
+                error = f"Ошибка WA: {response.status_code} - {response.text}"
+                retryable = response.status_code in self.RETRY_STATUSES
+            if not retryable or attempt == WA_RETRIES:
+                break
+            await asyncio.sleep(self._backoff(attempt, response))
+        self.errors += 1
+        self.breaker.record_failure()
+        return None, error
+
+    def stats(self):
+        return {
+            "breaker": self.breaker.state,
+            "breaker_retry_in": self.breaker.retry_in(),
+            "breaker_trips": self.breaker.trips,
+            "consecutive_failures": self.breaker.failures,
+            "in_flight": self.in_flight,
+            "max_connections": WA_MAX_CONNECTIONS,
+            "max_keepalive": WA_MAX_KEEPALIVE,
+            "requests": self.requests,
+            "retries": self.retries,
+            "errors": self.errors,
+        }
+
+green_api = GreenApiClient()
+
 async def send_whatsapp_message(phone, text):
-    """Отправляет сообщение через Green-API, используя httpx"""
-    url = f"https://api.green-api.com/waInstance{WA_ID_INSTANCE}/sendMessage/{WA_API_TOKEN}"
+    """Отправляет сообщение через Green-API (общий пул соединений green_api)"""
     payload = {
         "chatId": f"{phone}@c.us",
         "message": text
     }
     
     try:
-        # В httpx используется AsyncClient
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(url, json=payload)
+        response, error = await green_api.post("sendMessage", payload)
+        if response is None:
+            print(f"❌ Ошибка при отправке WA: {error}")
+            metrics.inc('wa_failures')
+            return False, error
             
-            if response.status_code == 200:
-                result = response.json()
-                return True, result.get("idMessage")
-            else:
-                return False, f"Ошибка WA: {response.status_code} - {response.text}"
+        if response.status_code == 200:
+            result = response.json()
+            return True, result.get("idMessage")
+        else:
+            metrics.inc('wa_failures')
+            return False, f"Ошибка WA: {response.status_code} - {response.text}"
                 
     except Exception as e:
         print(f"❌ Исключение при отправке WA: {e}")
+        metrics.inc('wa_failures')
         return False, str(e)
 
+async def request_params():
+    # Параметры можно передать и в query string, и в JSON-теле (1С шлет и GET, и POST)
+    params = dict(request.args)
+    body = await request.get_json(silent=True)
+    if isinstance(body, dict):
+        params.update(body)
+    return params
+
+PENDING_PAGE_SQL = """
+    SELECT * FROM outbound_logs
+    WHERE status = 'pending' AND id > ?
+    ORDER BY id LIMIT ?
+"""
+
+async def fetch_pending_page(since_id, limit):
+    async with database.read() as db:
+        async with db.execute(PENDING_PAGE_SQL, (since_id, limit)) as c:
+            return [dict(r) for r in await c.fetchall()]
+
+async def stream_pending(since_id, limit):
+    # Отдаем строки порциями по курсору id: соединение из пула берем на каждую порцию и возвращаем до yield,
+    # иначе медленные клиенты 1С держали бы весь пул читателей, пока дочитывают ответ
+    last_id, left = since_id, limit
+    while left > 0:
+        rows = await fetch_pending_page(last_id, min(FETCH_CHUNK, left))
+        if not rows:
+            break
+        last_id, left = rows[-1]['id'], left - len(rows)
+        yield "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in rows)
+        if len(rows) < FETCH_CHUNK:
+            break
+
 @app.route('/fetch_new', methods=['GET', 'POST'])
 async def fetch_new():
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    params = await request_params()
+
+    # Курсорный режим: ?since_id=N&limit=M, ответ в NDJSON, подтверждение отдельно через /ack
+    if 'since_id' in params or 'limit' in params:
+        try:
+            since_id = int(params.get('since_id') or 0)
+            limit = min(int(params.get('limit') or FETCH_LIMIT), FETCH_LIMIT_MAX)
+        except (TypeError, ValueError):
+            return jsonify({"error": "since_id и limit должны быть числами"}), 400
+        return stream_pending(since_id, max(1, limit)), 200, {"Content-Type": "application/x-ndjson; charset=utf-8"}
+
+    # Старый режим (для уже развернутых обработок 1С): все разом и сразу отмечаем выданным
+    # Чтение и отметка в одной транзакции писателя, чтобы не потерять строки между ними
+    async with database.write() as db:
         async with db.execute("SELECT * FROM outbound_logs WHERE status = 'pending'") as c:
             rows = [dict(r) for r in await c.fetchall()]
         if rows:
             ids = [r['id'] for r in rows]
             await db.execute(f"UPDATE outbound_logs SET status='ok' WHERE id IN ({','.join(['?']*len(ids))})", ids)
-            await db.commit()
-        return jsonify(rows)
+    return jsonify(rows)
+
+@app.route('/fetch_wait', methods=['GET', 'POST'])
+async def fetch_wait():
+    # Long-poll: держим запрос, пока log_to_db не запишет новые строки или не выйдет timeout
+    params = await request_params()
+    try:
+        since_id = int(params.get('since_id') or 0)
+        limit = max(1, min(int(params.get('limit') or FETCH_LIMIT), FETCH_LIMIT_MAX))
+        timeout = min(float(params.get('timeout') or FEED_WAIT_DEFAULT), FEED_WAIT_MAX)
+    except (TypeError, ValueError):
+        return jsonify({"error": "since_id, limit и timeout должны быть числами"}), 400
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    seen_id = since_id
+    while True:
+        if change_feed.last_id > seen_id:
+            snapshot = change_feed.last_id
+            rows = await fetch_pending_page(since_id, limit)
+            if rows:
+                return jsonify(rows)
+            # Все новее since_id уже подтверждено — ждем только то, что появится после снимка
+            seen_id = snapshot
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return jsonify([])
+        await change_feed.wait(seen_id, remaining)
+
+@app.route('/fetch_stream')
+async def fetch_stream():
+    # Server-Sent Events: id события = id строки, переподключение продолжает с Last-Event-ID
+    params = await request_params()
+    try:
+        since_id = int(request.headers.get('Last-Event-ID') or params.get('since_id') or 0)
+    except (TypeError, ValueError):
+        return jsonify({"error": "since_id должен быть числом"}), 400
+
+    async def events_gen():
+        cursor_id = since_id
+        seen_id = since_id
+        while True:
+            if change_feed.last_id > seen_id:
+                snapshot = change_feed.last_id
+                rows = await fetch_pending_page(cursor_id, FETCH_CHUNK)
+                for r in rows:
+                    cursor_id = r['id']
+                    yield f"id: {r['id']}\nevent: message\ndata: {json.dumps(r, ensure_ascii=False, default=str)}\n\n"
+                if len(rows) == FETCH_CHUNK:
+                    continue  # Есть еще хвост — дочитываем без ожидания
+                seen_id = max(snapshot, cursor_id)
+            if not await change_feed.wait(seen_id, FEED_PING_INTERVAL):
+                yield ": ping\n\n"  # Не даем прокси закрыть молчащее соединение
+
+    response = await make_response(events_gen(), 200, {
+        "Content-Type": "text/event-stream; charset=utf-8",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    response.timeout = None  # Поток бессрочный, стандартный RESPONSE_TIMEOUT Quart его бы оборвал
+    return response
+
+@app.route('/ack', methods=['POST'])
+async def ack():
+    # 1С подтверждает, что забрала все строки до up_to_id включительно
+    params = await request_params()
+    try:
+        up_to_id = int(params.get('up_to_id'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "up_to_id обязателен и должен быть числом"}), 400
+
+    async with database.write() as db:
+        cursor = await db.execute(
+            "UPDATE outbound_logs SET status = 'ok' WHERE status = 'pending' AND id <= ?",
+            (up_to_id,)
+        )
+    return jsonify({"status": "ok", "acked": cursor.rowcount}), 200
+
+@app.route('/jobs/<job_id>')
+async def job_status(job_id):
+    job = send_scheduler.get(job_id)
+    if job is not None:
+        return jsonify(job.info()), 200
+    # Задание, принятое API-процессом и переданное Telegram-воркеру
+    job = await job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Задача не найдена (или уже вытеснена из истории)"}), 404
+    return jsonify(job_queue.info(job)), 200
+
+@app.route('/stats')
+async def stats():
+    # Внутренние счетчики для мониторинга
+    return jsonify({
+        "jobs": job_queue.stats(),
+        "telegram": shard_router.stats(),
+        "topic_cache": topic_cache.stats(),
+        "send_scheduler": send_scheduler.stats(),
+        "green_api": green_api.stats(),
+        "entity_cache": entity_cache.stats(),
+        "media_cache": media_cache.stats(),
+        "media_store": media_store.stats(),
+        "albums": album_buffer.stats(),
+    })
+
+@app.route('/metrics')
+async def metrics_endpoint():
+    # Для Prometheus: гистограммы задержек, счетчики и размер очередей; все из памяти, кроме одного COUNT по индексу
+    async with database.read() as db:
+        async with db.execute("SELECT COUNT(*) FROM outbound_logs WHERE status = 'pending'") as cursor:
+            pending_rows = (await cursor.fetchone())[0]
+    counter = lambda name: [({}, metrics.counters.get(name, 0))]
+    families = [
+        ("tg1c_flood_waits_total", "counter", "Telegram FloodWait errors in the send scheduler",
+         [({}, send_scheduler.flood_waits)]),
+        ("tg1c_topic_creations_total", "counter", "Forum topics created", counter('topic_creations')),
+        ("tg1c_wa_failures_total", "counter", "Failed WhatsApp sends via Green-API", counter('wa_failures')),
+        ("tg1c_cache_hits_total", "counter", "In-memory cache hits",
+         [({"cache": "topic"}, topic_cache.hits), ({"cache": "entity"}, entity_cache.hits), ({"cache": "media"}, media_cache.hits)]),
+        ("tg1c_cache_misses_total", "counter", "In-memory cache misses",
+         [({"cache": "topic"}, topic_cache.misses), ({"cache": "entity"}, entity_cache.misses)]),
+        ("tg1c_outbound_pending_rows", "gauge", "Rows in outbound_logs not yet acknowledged by 1C", [({}, pending_rows)]),
+        ("tg1c_media_store_bytes", "gauge", "Size of the attachment store in FILES_DIR", [({}, media_store.total)]),
+        ("tg1c_log_queue_depth", "gauge", "Rows waiting in the write-behind log queue",
+         [({}, log_writer.queue.qsize() if log_writer.queue else 0)]),
+        ("tg1c_send_queue_depth", "gauge", "Jobs waiting in the Telegram send scheduler",
+         [({}, send_scheduler.queue.qsize() if send_scheduler.queue else 0)]),
+        ("tg1c_jobs_active", "gauge", "Jobs being executed by this Telegram worker", [({}, len(job_queue.active))]),
+        ("tg1c_telegram_ready", "gauge", "Telegram shard connection is ready",
+         [({"group": str(s.group_id)}, int(s.telegram.is_ready())) for s in shard_router.shards]),
+    ]
+    return Response(metrics.render(families), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route('/shards')
+async def shards_info():
+    # Нагрузка по шардам: сколько клиентов (тем) в каждом форуме и принимает ли он новых
+    loads = await shard_router.loads()
+    return jsonify([dict(s.stats(), clients=loads.get(str(s.group_id), 0)) for s in shard_router.shards]), 200
+
+@app.route('/shards/rebalance', methods=['POST'])
+async def shards_rebalance():
+    return jsonify(await rebalance_shards()), 200
+
+@app.route('/live')
+async def live():
+    # Процесс жив и event loop отвечает; состояние Telegram сюда не входит, чтобы оркестратор не перезапускал зря
+    return jsonify({"status": "ok"}), 200
+
+@app.route('/ready')
+async def ready():
+    # Готов принимать отправки: клиент подключен и авторизован, кэши прогреты.
+    # API-процессу Telegram не нужен: отправки ждут воркера в очереди
+    if APP_ROLE == ROLE_API:
+        return jsonify({"role": APP_ROLE, "ready": True}), 200
+    # С несколькими аккаунтами готовность — хотя бы один; упавшие видны в списке шардов
+    shards = shard_router.stats()
+    status = 200 if any(s['ready'] for s in shards) else 503
+    return jsonify({"ready": status == 200, "shards": shards}), status
+
+class MediaFileBody(FileBody):
+    buffer_size = FILE_BUFFER_SIZE
+
+class AppResponse(Response):
+    file_body_class = MediaFileBody
+
+app.response_class = AppResponse
+
+async def send_media(path, mime_type=None, etag=None):
+    # ETag/Last-Modified -> 304, Range -> 206 (докачка, перемотка видео); ссылки неизменяемые — кэшируем надолго
+    response = await quart_send_file(path, mimetype=mime_type, cache_timeout=FILE_CACHE_MAX_AGE)
+    response.cache_control.immutable = True
+    if etag:
+        response.set_etag(etag)
+    await response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(path))
+    response.headers["Accept-Ranges"] = "bytes"  # Quart ставит его только на 206, а клиенту нужно знать о докачке заранее
+    response.timeout = None  # Большие видео отдаются дольше стандартного таймаута ответа
+    return response
+
+def parse_range(size):
+    # Один байтовый диапазон для докачки еще не скачанного файла; иначе None — отдаем целиком
+    if not size or request.range is None or request.range.units != 'bytes' or len(request.range.ranges) != 1:
+        return None
+    return request.range.range_for_length(size)
 
 @app.route('/get_file/<filename>')
-async def get_file(filename): return await send_from_directory(FILES_DIR, filename)
+async def get_file(filename):
+    # Старые файлы (до хранилища) лежат прямо в FILES_DIR под своим именем
+    legacy_path = safe_join(FILES_DIR, filename)
+    if legacy_path is None or filename.startswith('.'):
+        return jsonify({"error": "Файл не найден"}), 404
+    if os.path.isfile(legacy_path):
+        return await send_media(legacy_path)
+
+    ref = await lazy_media.lookup(filename)
+    if not ref:
+        return jsonify({"error": "Файл не найден"}), 404
+    mime_type = ref['mime_type'] or "application/octet-stream"
+    path = await media_store.locate(ref['sha256'])
+    if APP_ROLE == ROLE_API and not (path and os.path.isfile(path)):
+        # Качает только Telegram-воркер; дожидаемся, пока файл появится в общем хранилище
+        job = await job_queue.wait(await job_queue.submit("fetch_media", {"filename": filename}), MEDIA_DOWNLOAD_TIMEOUT)
+        if job is None:
+            return jsonify({"error": "Файл еще скачивается, повторите запрос позже"}), 504
+        if job['status'] != "done":
+            return Response(job['result'], status=job['http_status'], content_type="application/json")
+        ref = await lazy_media.lookup(filename)
+        path = await media_store.locate(ref['sha256'])
+    if path and os.path.isfile(path):
+        media_store.touch(ref['sha256'])
+        # Содержимое адресуется хэшем — он и есть сильный ETag
+        return await send_media(path, mime_type, etag=ref['sha256'])
+
+    # Файла на диске нет (еще не качали или вытеснен) — тянем из Telegram и отдаем по мере скачивания
+    dl = lazy_media.start(ref)
+    await lazy_media.wait_started(dl)
+    if dl.error and not dl.written:
+        return jsonify({"error": str(dl.error)}), 404
+
+    headers = {"Content-Type": mime_type}
+    size = ref['size']
+    byte_range = parse_range(size)
+    if byte_range:
+        begin, end = byte_range
+        headers["Content-Length"] = str(end - begin)
+        headers["Content-Range"] = ContentRange('bytes', begin, end, size).to_header()
+        response = await make_response(lazy_media.stream(dl, begin, end), 206, headers)
+    else:
+        if size:
+            headers["Content-Length"] = str(size)
+        response = await make_response(lazy_media.stream(dl), 200, headers)
+    if size:
+        response.headers["Accept-Ranges"] = "bytes"
+    response.timeout = None  # Большие видео качаются дольше стандартного таймаута ответа
+    return response
 
 @app.before_serving
 async def startup():
     print("🚀 [STARTUP] Инициализация приложения началась...", flush=True)
+    await database.open()
     await init_db()
-    # Запускаем слушатель как отдельную фоновую задачу
-    asyncio.create_task(start_listener())
-    print("🚀 [STARTUP] Задача start_listener отправлена в event loop", flush=True)
+    async with database.read() as db:
+        async with db.execute("SELECT MAX(id) FROM outbound_logs") as c:
+            change_feed.start((await c.fetchone())[0])
+    await media_store.load(owner=APP_ROLE != ROLE_API)
+    media_store.start()
+    log_writer.start()
+    await shard_router.load()
+    if APP_ROLE == ROLE_API:
+        # Сессией Telegram владеет воркер; здесь только HTTP и очередь заданий
+        change_feed.start_polling(FEED_POLL_MS / 1000)
+        shard_router.start(SHARD_RELOAD_INTERVAL, clients=False)
+        print(f"🚀 [STARTUP] API-процесс готов (pid {os.getpid()})", flush=True)
+        return
+    await topic_cache.warm()
+    await entity_cache.load()
+    await media_cache.load()
+    topic_liveness.start()
+    send_scheduler.start()
+    green_api.start()
+    media_cache.start()
+    await job_queue.start(JOB_HANDLERS)
+    # Клиенты Telegram (по одному на шард) поднимаем последними: готовность наступает, когда кэши уже прогреты
+    shard_router.start(SHARD_RELOAD_INTERVAL)
+    print(f"🚀 [STARTUP] Подключение к Telegram запущено в фоне (шардов: {len(shard_router.shards)})", flush=True)
+
+@app.after_serving
+async def shutdown():
+    print("🛑 [SHUTDOWN] Остановка приложения...", flush=True)
+    await job_queue.stop()
+    await change_feed.stop()
+    await topic_liveness.stop()
+    await album_buffer.stop()
+    await send_scheduler.stop()
+    await shard_router.stop()
+    await green_api.close()
+    await media_cache.close()
+    await media_store.stop()
+    await topic_deletions.stop()
+    await log_writer.stop()
+    await database.close()
+
+async def rebalance_command():
+    # python app.py rebalance — пересчитать нагрузку шардов; работающие процессы подхватят итог сами
+    await database.open()
+    await init_db()
+    try:
+        for row in await rebalance_shards():
+            state = "принимает новых" if row['accepting'] else "закрыт для новых"
+            print(f"📊 Шард {row['group_id']}: клиентов {row['clients']}, {state}", flush=True)
+    finally:
+        await database.close()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    if sys.argv[1:2] == ['rebalance']:
+        asyncio.run(rebalance_command())
+    elif APP_ROLE == ROLE_API and API_WORKERS > 1:
+        # Несколько API-процессов на одном порту; Telegram-воркер запускается отдельно с APP_ROLE=telegram
+        from hypercorn.config import Config
+        from hypercorn.run import run
+        config = Config()
+        config.application_path = "app:app"
+        config.bind = [f"0.0.0.0:{PORT}"]
+        config.workers = API_WORKERS
+        run(config)
+    else:
+        app.run(host='0.0.0.0', port=PORT)
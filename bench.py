@@ -0,0 +1,538 @@
+"""Нагрузочный стенд шлюза: настоящий app.py, поддельные Telegram и Green-API в том же процессе.
+
+Запуск:  python bench.py --duration 30 --send-rate 200 --inbound-rate 50
+Отчет:   msgs/sec, p50/p99 по каждому сценарию и скорость записи в SQLite; --json — то же для сравнения прогонов.
+
+--split: API в отдельном процессе (APP_ROLE=api), отправки идут Telegram-воркеру стенда через таблицу jobs.
+Лимиты отправки (TG_*_RATE) по умолчанию сняты, чтобы мерить сам шлюз; --real-limits оставляет боевые.
+База и FILES_DIR стенда — во временном каталоге, порты должны быть свободны. Запускать рядом с живым шлюзом можно,
+но он делит с замером CPU и диск — цифры будут занижены, а шлюз притормозит.
+"""
+import os, sys, asyncio, argparse, tempfile, shutil, time, random, json, uuid, socket
+from types import SimpleNamespace
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Нагрузочный стенд Telegramm-1C")
+    p.add_argument("--duration", type=float, default=20, help="длительность замера, сек")
+    p.add_argument("--clients", type=int, default=200, help="сколько клиентов (тем) создать на прогреве")
+    p.add_argument("--send-rate", type=float, default=100, help="/send в Telegram, запросов/сек")
+    p.add_argument("--wa-rate", type=float, default=20, help="/send в WhatsApp, запросов/сек")
+    p.add_argument("--file-rate", type=float, default=10, help="/send_file, запросов/сек")
+    p.add_argument("--inbound-rate", type=float, default=50, help="ответы менеджеров (NewMessage), событий/сек")
+    p.add_argument("--album-rate", type=float, default=0, help="альбомы менеджеров (общий grouped_id), альбомов/сек")
+    p.add_argument("--album-size", type=int, default=10, help="частей в альбоме")
+    p.add_argument("--fetch-rate", type=float, default=5, help="/fetch_new + /ack, запросов/сек")
+    p.add_argument("--async-ratio", type=float, default=0.0, help="доля /send?async=1 (ответ 202, отправка в фоне)")
+    p.add_argument("--new-client-ratio", type=float, default=0.0, help="доля /send новым клиентам (создание темы)")
+    p.add_argument("--tg-latency", type=float, default=30, help="средняя задержка RPC Telegram, мс")
+    p.add_argument("--tg-jitter", type=float, default=0.5, help="разброс задержки RPC, доля от средней")
+    p.add_argument("--topic-latency", type=float, default=150, help="задержка CreateForumTopicRequest, мс")
+    p.add_argument("--flood-rate", type=float, default=0.0, help="вероятность FloodWait на RPC отправки")
+    p.add_argument("--flood-seconds", type=int, default=1, help="длительность FloodWait, сек")
+    p.add_argument("--wa-latency", type=float, default=80, help="задержка Green-API, мс")
+    p.add_argument("--wa-fail-rate", type=float, default=0.0, help="доля ответов 500 от Green-API")
+    p.add_argument("--file-size", type=int, default=256, help="размер файла для /send_file, КБ")
+    p.add_argument("--port", type=int, default=5055, help="порт шлюза")
+    p.add_argument("--fake-port", type=int, default=5056, help="порт поддельного Green-API")
+    p.add_argument("--split", action="store_true", help="API отдельным процессом (APP_ROLE=api) перед воркером стенда")
+    p.add_argument("--worker-port", type=int, default=5057, help="порт Telegram-воркера в режиме --split")
+    p.add_argument("--real-limits", action="store_true", help="не снимать лимиты планировщика отправки")
+    p.add_argument("--keep", action="store_true", help="не удалять рабочий каталог с базой")
+    p.add_argument("--verbose", action="store_true", help="не глушить логи приложения")
+    p.add_argument("--json", action="store_true", help="отчет в JSON")
+    return p.parse_args()
+
+
+args = parse_args()
+
+
+def check_ports(*ports):
+    # Занятый порт — скорее всего живой шлюз или прошлый прогон: не запускаемся поверх него
+    for port in ports:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                sys.exit(f"❌ Порт {port} занят — укажите другой через --port/--fake-port")
+
+
+check_ports(args.port, args.fake_port, *([args.worker_port] if args.split else []))
+
+# Конфиг app.py читается при импорте — окружение стенда задаем до него
+WORKDIR = tempfile.mkdtemp(prefix="tg1c_bench_")
+os.environ["DB_PATH"] = os.path.join(WORKDIR, "bench.db")
+# Свой каталог файлов: при старте хранилище чистит FILES_DIR/store/.tmp — чужие недокачанные файлы трогать нельзя
+os.environ["FILES_DIR"] = os.path.join(WORKDIR, "files")
+os.environ["WA_API_URL"] = f"http://127.0.0.1:{args.fake_port}"
+os.environ["BASE_URL"] = f"http://127.0.0.1:{args.port}"
+os.environ["APP_ROLE"] = "telegram"
+os.environ.setdefault("WA_ID_INSTANCE", "bench")
+os.environ.setdefault("WA_API_TOKEN", "bench")
+if not args.real_limits:
+    for name in ("TG_GLOBAL_RATE", "TG_GLOBAL_BURST", "TG_PEER_RATE", "TG_PEER_BURST", "TG_GROUP_RATE", "TG_GROUP_BURST"):
+        os.environ[name] = "1000000"
+
+import httpx
+from quart import Quart, Response, request, jsonify
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from telethon import events, functions, types, errors
+
+import app as gateway
+
+MANAGER_PHONE = "79000000001"
+CLIENT_BASE = 79100000000
+
+
+# --- ПОДДЕЛЬНЫЙ TELEGRAM ---
+class FakeTelegramClient:
+    """Вместо TelegramClient: задержка RPC, FloodWait с заданной вероятностью, создание тем, события NewMessage"""
+
+    def __init__(self, session, api_id, api_hash):
+        self.session = session
+        self.handlers = []
+        self.disconnected = None
+        self.next_id = 1000
+        self.rpc_calls = 0
+        self.flood_waits = 0
+        self.topics_created = 0
+        self.albums = {}
+
+    # Жизненный цикл, который ждет TelegramSupervisor
+    async def connect(self):
+        self.disconnected = asyncio.get_running_loop().create_future()
+
+    def is_connected(self):
+        return self.disconnected is not None and not self.disconnected.done()
+
+    async def is_user_authorized(self):
+        return True
+
+    async def disconnect(self):
+        if self.is_connected():
+            self.disconnected.set_result(None)
+
+    async def run_until_disconnected(self):
+        await self.disconnected
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((event, callback))
+
+    def on(self, event):
+        def decorator(callback):
+            self.add_event_handler(callback, event)
+            return callback
+        return decorator
+
+    async def dispatch(self, event):
+        # Как Telethon: событие получают обработчики NewMessage по очереди
+        for builder, callback in self.handlers:
+            if isinstance(builder, events.NewMessage):
+                await callback(event)
+
+    # RPC
+    def _message_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    async def _rpc(self, latency_ms=None, flood=False):
+        self.rpc_calls += 1
+        latency = (args.tg_latency if latency_ms is None else latency_ms) / 1000
+        await asyncio.sleep(max(0, random.uniform(latency * (1 - args.tg_jitter), latency * (1 + args.tg_jitter))))
+        if flood and args.flood_rate and random.random() < args.flood_rate:
+            self.flood_waits += 1
+            raise errors.FloodWaitError(request=None, capture=args.flood_seconds)
+
+    async def __call__(self, req):
+        if isinstance(req, functions.messages.CreateForumTopicRequest):
+            await self._rpc(args.topic_latency)
+            self.topics_created += 1
+            msg_id = self._message_id()
+            msg = types.MessageService(id=msg_id, peer_id=types.PeerChannel(1), date=None,
+                                       action=types.MessageActionTopicCreate(title=req.title, icon_color=0))
+            return types.Updates(updates=[types.UpdateMessageID(id=msg_id, random_id=1),
+                                          types.UpdateNewChannelMessage(message=msg, pts=1, pts_count=1)],
+                                 users=[], chats=[], date=None, seq=0)
+        raise NotImplementedError(type(req).__name__)
+
+    async def send_message(self, peer, text, reply_to=None):
+        await self._rpc(flood=True)
+        return SimpleNamespace(id=self._message_id())
+
+    async def send_file(self, peer, file, caption=None):
+        await self._rpc(flood=True)
+        if isinstance(file, list):
+            # Альбом — один RPC, в ответ сообщение на каждую часть
+            waiter = self.albums.pop(getattr(file[0], "grouped_id", None), None)
+            if waiter and not waiter.done():
+                waiter.set_result(len(file))
+            return [SimpleNamespace(id=self._message_id(), media=media) for media in file]
+        doc = types.Document(id=random.getrandbits(62), access_hash=1, file_reference=b"ref", date=None,
+                             mime_type="application/pdf", size=args.file_size * 1024, dc_id=1, attributes=[])
+        return SimpleNamespace(id=self._message_id(), media=types.MessageMediaDocument(document=doc))
+
+    async def upload_file(self, path, file_name=None):
+        # Загрузка пропорциональна размеру: ~10 МБ/с
+        await self._rpc(args.tg_latency + os.path.getsize(path) / 10000)
+        return types.InputFile(id=random.getrandbits(62), parts=1, name=file_name, md5_checksum="")
+
+    async def get_entity(self, phone):
+        await self._rpc()
+        return types.User(id=int(str(phone)[-9:]), access_hash=1, first_name="Bench")
+
+    async def get_messages(self, peer, ids=None):
+        # Проверка живости тем: все темы на месте
+        await self._rpc()
+        return [SimpleNamespace(id=i) for i in ids] if isinstance(ids, list) else None
+
+    async def iter_messages(self, peer, limit=None):
+        await self._rpc()
+        return
+        yield
+
+
+class FakeNewMessage:
+    """Ответ менеджера в теме клиента — то, что handler получает от Telethon"""
+
+    def __init__(self, group_id, topic_id, text, grouped_id=None):
+        self.out = False
+        self.is_group = True
+        self.chat_id = group_id
+        self.reply_to_msg_id = topic_id
+        self.raw_text = text
+        self.sender_id = int(MANAGER_PHONE)
+        media = None
+        if grouped_id:
+            # Фото альбома: ссылка на уже лежащий в Telegram файл, шлюз его не качает
+            media = SimpleNamespace(grouped_id=grouped_id, document=SimpleNamespace(mime_type="image/jpeg", size=200000, attributes=[]))
+        self.message = SimpleNamespace(id=random.getrandbits(31), media=media, grouped_id=grouped_id)
+
+    async def get_sender(self):
+        return SimpleNamespace(phone=MANAGER_PHONE)
+
+
+# --- ПОДДЕЛЬНЫЙ GREEN-API (и раздача файла для /send_file) ---
+fake_green = Quart("fake_green_api")
+FILE_BODY = os.urandom(args.file_size * 1024)
+FILE_ETAG = '"bench-file"'
+
+
+@fake_green.route("/waInstance<instance>/<method>/<token>", methods=["POST"])
+async def fake_green_method(instance, method, token):
+    await request.get_data()
+    await asyncio.sleep(args.wa_latency / 1000)
+    if args.wa_fail_rate and random.random() < args.wa_fail_rate:
+        return jsonify({"error": "bench failure"}), 500
+    return jsonify({"idMessage": uuid.uuid4().hex.upper()})
+
+
+@fake_green.route("/files/report.pdf")
+async def fake_file():
+    if request.headers.get("If-None-Match") == FILE_ETAG:
+        return Response(b"", status=304)
+    return Response(FILE_BODY, content_type="application/pdf", headers={"ETag": FILE_ETAG})
+
+
+# --- НАГРУЗКА ---
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Scenario:
+    """Открытая модель нагрузки: вызовы стартуют по расписанию rate/сек, не дожидаясь ответов"""
+
+    def __init__(self, name, rate, call):
+        self.name = name
+        self.rate = rate
+        self.call = call
+        self.latencies = []
+        self.errors = 0
+        self.items = 0
+        self.last_error = None
+
+    async def _one(self, i):
+        start = time.perf_counter()
+        try:
+            self.items += await self.call(i) or 0
+        except Exception as e:
+            self.errors += 1
+            self.last_error = f"{type(e).__name__}: {e}"
+        else:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def run(self, duration):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        tasks = []
+        for i in range(int(self.rate * duration)):
+            delay = started + i / self.rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(self._one(i)))
+        await asyncio.gather(*tasks)
+        self.elapsed = loop.time() - started
+
+    def report(self):
+        ms = lambda v: round(v * 1000, 1) if v is not None else None
+        return {
+            "scenario": self.name,
+            "target_rate": self.rate,
+            "ok": len(self.latencies),
+            "errors": self.errors,
+            "per_sec": round(len(self.latencies) / self.elapsed, 1) if self.elapsed else 0,
+            "p50_ms": ms(percentile(self.latencies, 0.5)),
+            "p99_ms": ms(percentile(self.latencies, 0.99)),
+            "max_ms": ms(max(self.latencies) if self.latencies else None),
+            "items": self.items,
+            "last_error": self.last_error,
+        }
+
+
+def client_phone(i):
+    return str(CLIENT_BASE + i)
+
+
+def checked(resp):
+    if resp.status_code >= 300:
+        raise RuntimeError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+    return resp
+
+
+def build_scenarios(http, fake_tg):
+    fetch_cursor = {"since_id": 0}
+    topics = [row for row in gateway.topic_cache.by_client.values() if row.get("topic_id")]
+
+    async def send_tg(i):
+        if args.new_client_ratio and random.random() < args.new_client_ratio:
+            phone = client_phone(args.clients + 100000 + i)
+        else:
+            phone = client_phone(random.randrange(args.clients))
+        path = "/send?async=1" if args.async_ratio and random.random() < args.async_ratio else "/send"
+        checked(await http.post(path, json={"phone": phone, "text": f"bench {i}", "manager": "Bench"}))
+
+    async def send_wa(i):
+        phone = client_phone(random.randrange(args.clients))
+        checked(await http.post("/send", json={"phone": phone, "text": f"wa {i}", "manager": "Bench", "messenger": "wa"}))
+
+    async def send_file(i):
+        phone = client_phone(random.randrange(args.clients))
+        checked(await http.post("/send_file", json={"phone": phone, "file": f"{os.environ['WA_API_URL']}/files/report.pdf",
+                                                    "text": f"file {i}", "manager": "Bench"}))
+
+    async def inbound(i):
+        row = random.choice(topics)
+        await fake_tg.dispatch(FakeNewMessage(int(row["group_id"]), row["topic_id"], f"reply {i}"))
+
+    async def album(i):
+        # Части приходят отдельными событиями; замер — до отправки клиенту одним send_file
+        row = random.choice(topics)
+        grouped_id = random.getrandbits(62)
+        done = fake_tg.albums[grouped_id] = asyncio.get_running_loop().create_future()
+        for part in range(args.album_size):
+            await fake_tg.dispatch(FakeNewMessage(int(row["group_id"]), row["topic_id"], f"album {i}" if part == 0 else "", grouped_id))
+        return await asyncio.wait_for(done, 30)
+
+    async def fetch(i):
+        # Как 1С: забрать страницу по курсору и подтвердить
+        resp = checked(await http.get("/fetch_new", params={"since_id": fetch_cursor["since_id"], "limit": 500}))
+        rows = [json.loads(line) for line in resp.text.splitlines() if line.strip()]
+        if rows:
+            up_to = rows[-1]["id"]
+            fetch_cursor["since_id"] = max(fetch_cursor["since_id"], up_to)
+            checked(await http.post("/ack", json={"up_to_id": up_to}))
+        return len(rows)
+
+    scenarios = [
+        Scenario("send_tg", args.send_rate, send_tg),
+        Scenario("send_wa", args.wa_rate, send_wa),
+        Scenario("send_file", args.file_rate, send_file),
+        Scenario("inbound", args.inbound_rate if topics else 0, inbound),
+        Scenario("album", args.album_rate if topics else 0, album),
+        Scenario("fetch_new", args.fetch_rate, fetch),
+    ]
+    return [s for s in scenarios if s.rate > 0]
+
+
+async def warm_up(http):
+    # Темы для всех клиентов создаем заранее: в замере по умолчанию только отправки в готовые темы
+    sem = asyncio.Semaphore(20)
+
+    async def create(i):
+        async with sem:
+            checked(await http.post("/send", json={"phone": client_phone(i), "text": "warm-up", "manager": "Bench"}))
+
+    await asyncio.gather(*[create(i) for i in range(args.clients)])
+
+
+async def sqlite_counters():
+    async with gateway.database.read() as db:
+        async with db.execute("SELECT COALESCE(MAX(id), 0) FROM outbound_logs") as cursor:
+            last_id = (await cursor.fetchone())[0]
+    commits = gateway.metrics.stages.get("sqlite_commit")
+    return last_id, commits.count if commits else 0
+
+
+def stage_summary(before):
+    # Средние задержки этапов из гистограмм /metrics за время замера
+    summary = {}
+    for stage, hist in gateway.metrics.stages.items():
+        count0, sum0 = before.get(stage, (0, 0.0))
+        count = hist.count - count0
+        if count:
+            summary[stage] = {"count": count, "avg_ms": round((hist.sum - sum0) / count * 1000, 2)}
+    return summary
+
+
+async def wait_ready(http, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await http.get("/ready")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("шлюз не стал готов")
+
+
+async def job_counters():
+    # --split: итог заданий воркера; 202 от API не значит, что сообщение ушло
+    async with gateway.database.read() as db:
+        async with db.execute("""
+            SELECT COUNT(*), COALESCE(SUM(status != 'done' OR http_status >= 400), 0) FROM jobs
+            WHERE status NOT IN ('queued', 'running')
+        """) as cursor:
+            total, failed = await cursor.fetchone()
+        async with db.execute("SELECT result FROM jobs WHERE status != 'done' OR http_status >= 400 LIMIT 1") as cursor:
+            row = await cursor.fetchone()
+    return {"finished": total, "failed": failed, "last_error": row[0][:200] if row and row[0] else None}
+
+
+async def count_jobs():
+    async with gateway.database.read() as db:
+        async with db.execute("SELECT COUNT(*) FROM jobs") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def start_api_process():
+    # Тот же app.py в роли API: общие DB_PATH и FILES_DIR, порт --port
+    env = dict(os.environ, APP_ROLE="api", PORT=str(args.port))
+    out = None if args.verbose else asyncio.subprocess.DEVNULL
+    return await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"),
+        env=env, stdout=out, stderr=out
+    )
+
+
+async def main():
+    fake_clients = []
+
+    def factory(session, api_id, api_hash):
+        client = FakeTelegramClient(session, api_id, api_hash)
+        fake_clients.append(client)
+        return client
+
+    for shard in gateway.shard_router.shards:
+        shard.telegram.client_factory = factory
+
+    stop = asyncio.Event()
+    servers = []
+    gateway_port = args.worker_port if args.split else args.port
+    for application, port in ((gateway.app, gateway_port), (fake_green, args.fake_port)):
+        config = Config()
+        config.bind = [f"127.0.0.1:{port}"]
+        config.accesslog = None
+        config.errorlog = None
+        servers.append(asyncio.ensure_future(serve(application, config, shutdown_trigger=stop.wait)))
+
+    limits = httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+    api_process = None
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=300, limits=limits) as http:
+        try:
+            if args.split:
+                async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{gateway_port}") as worker_http:
+                    await wait_ready(worker_http)
+                api_process = await start_api_process()
+            await wait_ready(http)
+            await warm_up(http)
+            scenarios = build_scenarios(http, fake_clients[0])
+            before_stages = {name: (h.count, h.sum) for name, h in gateway.metrics.stages.items()}
+            rows0, commits0 = await sqlite_counters()
+            started = time.perf_counter()
+            await asyncio.gather(*[s.run(args.duration) for s in scenarios])
+            elapsed = time.perf_counter() - started
+            # Строки логов пишутся отложенно — даем очереди сброситься перед подсчетом
+            await asyncio.sleep(gateway.LOG_FLUSH_MS / 1000 * 2)
+            rows1, commits1 = await sqlite_counters()
+            if args.split:
+                # Фоновые (async) задания воркер дорабатывает после замера — ждем, пока очередь опустеет
+                while (await job_counters())["finished"] < await count_jobs():
+                    await asyncio.sleep(0.1)
+                jobs = await job_counters()
+        finally:
+            if api_process is not None and api_process.returncode is None:
+                api_process.terminate()
+                await api_process.wait()
+            stop.set()
+            await asyncio.gather(*servers, return_exceptions=True)
+
+    return {
+        "mode": "split" if args.split else "single",
+        "duration_sec": round(elapsed, 2),
+        "jobs": jobs if args.split else None,
+        "scenarios": [s.report() for s in scenarios],
+        "sqlite": {
+            "rows_per_sec": round((rows1 - rows0) / elapsed, 1),
+            "commits_per_sec": round((commits1 - commits0) / elapsed, 1),
+        },
+        "stages": stage_summary(before_stages),
+        "telegram": {
+            "rpc_calls": sum(c.rpc_calls for c in fake_clients),
+            "flood_waits": sum(c.flood_waits for c in fake_clients),
+            "topics_created": sum(c.topics_created for c in fake_clients),
+        },
+    }
+
+
+def print_report(result):
+    print(f"\n📊 Замер {result['duration_sec']} сек ({'API отдельным процессом' if result['mode'] == 'split' else 'один процесс'})")
+    header = f"{'сценарий':<10} {'цель/с':>7} {'ok':>7} {'ошибок':>7} {'в сек':>8} {'p50 мс':>8} {'p99 мс':>8} {'max мс':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in result["scenarios"]:
+        print(f"{r['scenario']:<10} {r['target_rate']:>7g} {r['ok']:>7} {r['errors']:>7} {r['per_sec']:>8} "
+              f"{r['p50_ms'] or '-':>8} {r['p99_ms'] or '-':>8} {r['max_ms'] or '-':>8}")
+        if r["last_error"]:
+            print(f"   ⚠️ {r['last_error']}")
+    sqlite = result["sqlite"]
+    print(f"\n💾 SQLite: {sqlite['rows_per_sec']} строк outbound_logs/с, {sqlite['commits_per_sec']} commit/с")
+    print("⏱ Этапы (среднее): " + ", ".join(f"{k} {v['avg_ms']} мс x{v['count']}" for k, v in sorted(result["stages"].items())))
+    tg = result["telegram"]
+    print(f"📨 Telegram: RPC {tg['rpc_calls']}, FloodWait {tg['flood_waits']}, новых тем {tg['topics_created']}")
+    if result["jobs"]:
+        jobs = result["jobs"]
+        print(f"🔁 Задания API -> воркер: выполнено {jobs['finished']}, с ошибкой {jobs['failed']}")
+        if jobs["last_error"]:
+            print(f"   ⚠️ {jobs['last_error']}")
+
+
+if __name__ == "__main__":
+    real_stdout = sys.stdout
+    if not args.verbose:
+        # print() приложения на каждое сообщение сам по себе заметно тормозит — в замере он не нужен
+        sys.stdout = open(os.devnull, "w")
+    try:
+        result = asyncio.run(main())
+    finally:
+        sys.stdout = real_stdout
+        if not args.keep:
+            shutil.rmtree(WORKDIR, ignore_errors=True)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+    if result["jobs"] and result["jobs"]["failed"]:
+        # Ответ 202 уже ушел — упавшие задания видны только здесь; код возврата для проверки в CI
+        sys.exit(1)